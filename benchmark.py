@@ -0,0 +1,366 @@
+import argparse
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from multiprocessing import Process, Pipe, set_start_method
+
+import numpy as np
+from gym import spaces
+
+from rl import Runner, Statistics, create_env, create_agent
+from rl.env import MultiEnv
+from rl.multippo import MultiPPO
+from rl.env import EnvWorker, env_buffers, serve_envs
+from rl.env import UnityEnvAdapter, unity_envs
+from rl.env_server import EnvServer, RemoteEnv
+from rl.mock_unity import MockUnityEnvironment
+from train import build_parser
+
+
+def agents_throughput(args):
+    """ Training throughput of the agents in environment steps per second.
+    Includes acting, stepping the environments and optimization. """
+    for env_id in args.envs:
+        env = create_env(env_id, args.env_count)
+        for agent_type in args.agents:
+            agent_args = vars(build_parser().parse_args([
+                "--agent", agent_type,
+                "--env_count", str(args.env_count)]))
+            agent = create_agent(env, agent_args)
+            agent.eval = False
+
+            env.reset()
+            steps = 0
+            t0 = time.time()
+            while time.time() - t0 < args.duration:
+                states = env.states
+                actions = agent.step(states)
+                rewards, next_states, dones, _ = env.step(actions)
+                agent.transitions(states, actions, rewards, next_states, dones)
+                steps += len(states)
+            rate = steps / (time.time() - t0)
+            print("{} {}: {:.1f} steps/sec".format(env_id, agent_type, rate))
+        env.close()
+
+
+class ConstantEnv:
+    """ Environment with the payload of tennis and no simulation cost """
+
+    n_envs = 1
+    n_agents = 2
+    observation_size = 24
+    action_size = 2
+
+    def __init__(self):
+        rows = self.n_envs * self.n_agents
+        self._states = np.random.randn(rows, self.observation_size)
+        self._rewards = np.zeros(rows)
+        self._dones = np.zeros(rows, dtype=np.bool_)
+
+    def step(self, actions):
+        return lambda: (self._states, self._rewards, self._dones)
+
+    def reset(self):
+        return lambda: self._states
+
+    def close(self):
+        return
+
+
+def _pipe_worker(pipe):
+    env = ConstantEnv()
+    while True:
+        actions = pipe.recv()
+        if actions == "CLOSE":
+            return
+        pipe.send(env.step(actions)())
+
+
+def _shm_worker(pipe, buffers, channel):
+    pipe.send("READY")
+    serve_envs([ConstantEnv()], buffers, channel, auto_reset=False)
+
+
+def ipc_throughput(args):
+    """ Steps per second of the workers transport: pickled arrays in pipes
+    versus shared memory, with tennis sized observations and actions. """
+    set_start_method("spawn")
+    rows = ConstantEnv.n_envs * ConstantEnv.n_agents
+    actions = np.random.uniform(
+            -1, 1, (rows, ConstantEnv.action_size)).tolist()
+
+    pipes = []
+    for _ in range(args.workers):
+        pipe, worker_pipe = Pipe()
+        Process(target=_pipe_worker, args=(worker_pipe,), daemon=True).start()
+        pipes.append(pipe)
+
+    def pipe_step():
+        for pipe in pipes:
+            pipe.send(actions)
+        for pipe in pipes:
+            pipe.recv()
+
+    workers = []
+    for _ in range(args.workers):
+        worker = EnvWorker(
+                _shm_worker,
+                (),
+                env_buffers(
+                    rows,
+                    (ConstantEnv.observation_size,),
+                    (ConstantEnv.action_size,),
+                    np.float32))
+        worker.handshake()
+        workers.append(worker)
+
+    def shm_step():
+        promises = [worker.step(actions) for worker in workers]
+        for promise in promises:
+            promise()
+
+    for name, step in [("pipe", pipe_step), ("shared memory", shm_step)]:
+        steps = 0
+        t0 = time.time()
+        while time.time() - t0 < args.duration:
+            step()
+            steps += args.workers
+        rate = steps / (time.time() - t0)
+        print("{} workers, {}: {:.1f} steps/sec".format(
+            args.workers, name, rate))
+
+    for pipe in pipes:
+        pipe.send("CLOSE")
+    for worker in workers:
+        worker.close()
+
+
+def unity_time_scale(args):
+    """ Steps per second of a Unity environment in real time and in train
+    mode. MockUnityEnvironment stands in for the build, so the rates only
+    reflect the mock constants: 0.02 sec frames, sped up 100 times in train
+    mode, plus --latency ± --jitter. The rate of the bare mock is measured
+    too, the difference is the overhead of UnityEnvAdapter. In real time
+    it is hidden by the wait for the frame end. """
+    mock = {"latency": args.latency / 1000., "jitter": args.jitter / 1000.}
+    for env_id in args.unity_envs:
+        config = unity_envs[env_id]
+        for train_mode in [False, True]:
+            env = UnityEnvAdapter(
+                    config, render=False, worker_id=0,
+                    train_mode=train_mode, mock=mock)
+            actions = np.zeros(
+                    (env.n_envs * env.n_agents,) + env.action_space.shape,
+                    dtype=env.action_space.dtype)
+            env.reset()()
+            rate = _steps_per_sec(
+                    lambda: env.step(actions)(), args.duration)
+            env.close()
+
+            bare_env = MockUnityEnvironment(config, worker_id=0, **mock)
+            bare_env.reset(train_mode=train_mode)
+            bare_rate = _steps_per_sec(
+                    lambda: bare_env.step(actions), args.duration)
+
+            print("{} {}: {:.1f} steps/sec, bare mock {:.1f} steps/sec, "
+                  "adapter overhead {:.1f} us/step".format(
+                      env_id, "train mode" if train_mode else "real time",
+                      rate, bare_rate, (1. / rate - 1. / bare_rate) * 1e6))
+
+
+def _steps_per_sec(step, duration):
+    steps = 0
+    t0 = time.time()
+    while time.time() - t0 < duration:
+        step()
+        steps += 1
+    return steps / (time.time() - t0)
+
+
+def _run_env_server(address):
+    # Terminated by the benchmark, the environments are closed on exit
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    server = EnvServer(address)
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
+
+
+def env_server_overhead(args):
+    """ Steps per second of the environments created in the process
+    versus leased from an EnvServer, which adds a socket round trip to
+    every step. """
+    set_start_method("spawn")
+    address = os.path.join(tempfile.mkdtemp(), "env-server")
+    # Not a daemon, it starts the worker processes
+    server = Process(target=_run_env_server, args=(address,))
+    server.start()
+    while not os.path.exists(address):
+        time.sleep(0.1)
+
+    for env_id in args.envs:
+        options = dict(
+                env_id=env_id,
+                count=args.env_count,
+                envs_per_worker=args.envs_per_worker,
+                train_mode=True)
+        for name, make_env in [
+                ("local", lambda: create_env(**options)),
+                ("env server", lambda: RemoteEnv(address, **options))]:
+            env = make_env()
+            env.reset()
+            actions = np.zeros(
+                    (len(env.states),) + env.action_space.shape,
+                    dtype=env.action_space.dtype)
+            steps = 0
+            t0 = time.time()
+            while time.time() - t0 < args.duration:
+                env.step(actions)
+                steps += len(actions)
+            rate = steps / (time.time() - t0)
+            print("{} {}: {:.1f} steps/sec".format(env_id, name, rate))
+            env.close()
+    server.terminate()
+    server.join()
+    shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+
+
+def multippo_optimization(args):
+    """ Wall-clock time of a MultiPPO optimization with the sub-agents
+    optimized one after another and concurrently, tennis sized. """
+    observation_shape = (24,)
+    action_space = spaces.Box(-1., 1., shape=(2,), dtype=np.float32)
+    rows = args.env_count * args.n_agents
+    states = np.random.randn(rows, observation_shape[0]).astype(np.float32)
+    rewards = np.zeros(rows, dtype=np.float32)
+    dones = np.zeros(rows, dtype=np.bool_)
+    horizon = 128
+    # The parallel mode lowers the intra-op threads, so it goes second
+    for parallel in [False, True]:
+        agent = MultiPPO(
+                action_space, observation_shape, n_envs=args.env_count,
+                n_agents=args.n_agents, horizon=horizon, parallel=parallel)
+        agent.eval = False
+        elapsed = 0.
+        for _ in range(args.optimizations * horizon):
+            actions = agent.step(states)
+            t0 = time.time()
+            agent.transitions(states, actions, rewards, states, dones)
+            elapsed += time.time() - t0
+        print("{} agents, {}: {:.1f} ms per optimization".format(
+            args.n_agents, "parallel" if parallel else "sequential",
+            elapsed / args.optimizations * 1e3))
+
+
+class NullEnv:
+    """ Environment adapter without any work, episodes of 100 steps """
+
+    n_envs = 1
+    n_agents = 1
+    n_instances = 1
+    auto_reset = False
+    action_space = spaces.Discrete(2)
+    observation_space = spaces.Box(low=-1., high=1., shape=(4,))
+
+    def __init__(self):
+        self._states = np.zeros((1, 4), dtype=np.float32)
+        self._rewards = np.zeros(1, dtype=np.float32)
+        self._not_done = np.zeros(1, dtype=np.bool_)
+        self._done = np.ones(1, dtype=np.bool_)
+        self._steps = 0
+
+    def step(self, actions):
+        self._steps += 1
+        dones = self._done if self._steps % 100 == 0 else self._not_done
+        return lambda: (self._states, self._rewards, dones)
+
+    def reset(self):
+        return lambda: self._states
+
+    def render(self):
+        return
+
+    def close(self):
+        return
+
+
+class NullAgent:
+    """ Agent which acts and learns instantly """
+
+    eval = False
+
+    def __init__(self, n_envs):
+        self._actions = np.zeros(n_envs, dtype=np.int64)
+
+    def step(self, states):
+        return self._actions
+
+    def transitions(self, states, actions, rewards, next_states, dones):
+        return Statistics()
+
+    def episodes_end(self):
+        return
+
+
+def loop_overhead(args):
+    """ Time the Runner spends per step on its own, with an agent and
+    environments which do nothing. """
+    for count in [1, args.env_count]:
+        env = MultiEnv(NullEnv, count)
+        # Stats of the benchmark don't go to ./train
+        with tempfile.TemporaryDirectory() as summary_dir:
+            runner = Runner(
+                    env, NullAgent(count), "overhead", num_iterations=1,
+                    training_steps=args.steps, evaluation_steps=0,
+                    traj_buffer=None, bucket=None, summary_dir=summary_dir)
+            t0 = time.time()
+            stats, _ = runner._run_one_phase(is_training=True)
+            elapsed = time.time() - t0
+            runner.close()
+        steps = stats.sum("steps") / count
+        print("{} environments: {:.1f} us per step".format(
+            count, elapsed / steps * 1e6))
+
+
+benchmarks = {
+    "agents": agents_throughput,
+    "ipc": ipc_throughput,
+    "unity": unity_time_scale,
+    "overhead": loop_overhead,
+    "env_server": env_server_overhead,
+    "multippo": multippo_optimization,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(benchmarks.keys()))
+    parser.add_argument("--envs", nargs="+",
+            default=["CartPole-v1", "LunarLander-v2"])
+    parser.add_argument("--unity_envs", nargs="+", default=["tennis"])
+    parser.add_argument("--agents", nargs="+", default=["ppo", "impala"])
+    parser.add_argument("--env_count", type=int, default=20,
+            help="Environments count")
+    parser.add_argument("--workers", type=int, default=30,
+            help="Workers count of the ipc benchmark")
+    parser.add_argument("--envs_per_worker", type=int, default=1,
+            help="Environments per worker process, env_server benchmark")
+    parser.add_argument("--n_agents", type=int, default=2,
+            help="Sub-agents of the multippo benchmark")
+    parser.add_argument("--optimizations", type=int, default=10,
+            help="Optimizations of the multippo benchmark")
+    parser.add_argument("--latency", type=float, default=0.,
+            help="Simulation time of a mock Unity step, milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.,
+            help="Random deviation of the mock Unity step time, " +
+            "milliseconds")
+    parser.add_argument("--steps", type=int, default=100000,
+            help="Steps of the overhead benchmark")
+    parser.add_argument("--duration", type=float, default=60.,
+            help="Seconds to run each measurement")
+    args = parser.parse_args()
+    benchmarks[args.benchmark](args)
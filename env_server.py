@@ -0,0 +1,28 @@
+import argparse
+
+from rl.env_server import EnvServer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--address", type=str, default="/tmp/rl-env-server",
+            help="Unix socket to listen on, the same as --env_server " +
+            "of train.py")
+    parser.add_argument("--preload", nargs="+", default=[],
+            help="Environments to start before the first client " +
+            "connects, ENV_ID:COUNT[:ENVS_PER_WORKER]")
+    args = parser.parse_args()
+
+    server = EnvServer(args.address)
+    for spec in args.preload:
+        env_id, count, envs_per_worker = (spec.split(":") + ["0"])[:3]
+        server.preload({
+            "env_id": env_id,
+            "count": int(count),
+            "envs_per_worker": int(envs_per_worker),
+            "train_mode": True,
+        })
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
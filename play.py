@@ -4,6 +4,7 @@ import torch.nn as nn
 import time
 import os
 from rl import create_env, GreedyPolicy, Statistics
+from rl.normalizer import ObservationNormalizer
 import numpy as np
 from gym import spaces
 
@@ -30,6 +31,7 @@ def main(checkpoint, debug=False):
     s = s[1:]
 
     env = create_env(env_id)
+    load_normalizer(env, checkpoint)
 
     # Create agent
     sample_action = sample_action_fn(checkpoint, env.action_space)
@@ -53,6 +55,16 @@ def main(checkpoint, debug=False):
     env.close()
 
 
+def load_normalizer(env, checkpoint):
+    """ Normalizes the observations the same way as during training """
+    props = torch.load(checkpoint, map_location="cpu")
+    if not isinstance(props, dict) or "obs_normalizer" not in props:
+        return
+    env.normalizer = ObservationNormalizer.from_state_dict(
+            props["obs_normalizer"])
+    env.normalizer.training = False
+
+
 def play_episode(env, sample_action, debug=False):
     env.reset()
 
@@ -137,7 +149,7 @@ def sample_action_fn(checkpoint, action_space):
     # Derive agent from the checkpoint filename
     filename = os.path.basename(checkpoint)
     for s in filename.split('-'):
-        if s == "ppo":
+        if s in ("ppo", "impala"):
             return lambda states: _ppo(states, props)
         elif s == "multippo":
             return _multippo
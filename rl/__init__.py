@@ -10,6 +10,7 @@ from .actor_critic import ActorCritic
 from .trajectory import Trajectory, TrajectoryBuffer
 from .ppo import PPO
 from .multippo import MultiPPO
+from .impala import Impala
 from .runner import Runner
 from .env import create_env
 from .agent import create_agent
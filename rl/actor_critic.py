@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.optim as optim
 
 from rl import Statistics
+from rl.diagnostics import diagnostics
 
 
 class ActorCritic:
@@ -58,7 +59,14 @@ class ActorCritic:
             actions.append(action)
         return actions
 
-    def transitions(self, states, actions, rewards, next_states, term):
+    def episodes_end(self):
+        return
+
+    def transitions(
+            self, states, actions, rewards, next_states, term,
+            env_ids=None):
+        """ env_ids: environments of the transitions with partial
+        batches. Not needed, the updates are one-step TD. """
         stats = Statistics()
         if self.eval:
             return stats
@@ -112,19 +120,22 @@ class ActorCritic:
         stats.set('entropy', entropy.detach())
 
         # Log gradients
-        for p in self._net.parameters():
-            if p.grad is not None:
-                stats.set('grad_max', p.grad.abs().max().detach())
-                stats.set('grad_mean', (p.grad ** 2).mean().sqrt().detach())
+        if diagnostics.due("actor_critic/gradients"):
+            for p in self._net.parameters():
+                if p.grad is not None:
+                    stats.set('grad_max', p.grad.abs().max().detach())
+                    stats.set(
+                            'grad_mean', (p.grad ** 2).mean().sqrt().detach())
 
         # Log Kullback-Leibler divergence between the new
-        # and the old policy.
-        new_action_logits, _ = self._net(states)
-        new_action_probs = torch.nn.Softmax(dim=1)(new_action_logits)
-        kl = -(
-                (new_action_probs / action_probs).log() * action_probs
-            ).sum(dim=1).mean()
-        stats.set('kl', kl.detach())
+        # and the old policy. It takes another forward pass.
+        if diagnostics.due("actor_critic/kl"):
+            new_action_logits, _ = self._net(states)
+            new_action_probs = torch.nn.Softmax(dim=1)(new_action_logits)
+            kl = -(
+                    (new_action_probs / action_probs).log() * action_probs
+                ).sum(dim=1).mean()
+            stats.set('kl', kl.detach())
         return stats
 
 
@@ -1,4 +1,4 @@
-from rl import Reinforce, QLearning, ActorCritic, PPO, MultiPPO
+from rl import Reinforce, QLearning, ActorCritic, PPO, MultiPPO, Impala
 
 
 def create_agent(env, args):
@@ -58,7 +58,8 @@ def create_agent(env, args):
                 horizon=args["horizon"],
                 epochs=args["ppo_epochs"],
                 gae_lambda=args["gae_lambda"],
-                learning_rate=learning_rate)
+                learning_rate=learning_rate,
+                pipeline=args["pipeline"])
     elif agent_type == 'multippo':
         return MultiPPO(
                 action_space=action_space,
@@ -69,4 +70,17 @@ def create_agent(env, args):
                 horizon=args["horizon"],
                 epochs=args["ppo_epochs"],
                 gae_lambda=args["gae_lambda"],
+                learning_rate=learning_rate,
+                pipeline=args["pipeline"],
+                stacked=args["stacked"],
+                parallel=args["parallel_agents"],
+                shared_policy=args["shared_policy"],
+                agent_id=args["agent_id"])
+    elif agent_type == 'impala':
+        return Impala(
+                action_space=action_space,
+                observation_shape=observation_shape,
+                n_envs=env.n_envs * env.n_agents,
+                gamma=gamma,
+                unroll_length=args["unroll_length"],
                 learning_rate=learning_rate)
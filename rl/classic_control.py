@@ -0,0 +1,198 @@
+import math
+import numpy as np
+import gym
+
+
+class VectorEnv:
+    """ Batch of classic control environments stepped by array operations.
+
+    State of all the environments is a single (n_envs, state_size) array.
+    Finished environments are reset in place by a mask and their initial
+    observations are returned along with the terminal ones.
+    """
+
+    n_agents = 1
+    auto_reset = True
+
+    def __init__(self, env_id, count, max_steps, seed=None):
+        env = gym.make(env_id)
+        self.action_space = env.action_space
+        self.observation_space = env.observation_space
+        env.close()
+
+        self.n_envs = count
+        self.n_instances = count
+        self._max_steps = max_steps
+        self._rng = np.random.RandomState(seed)
+        self._steps = np.zeros(count, dtype=np.int64)
+        self.state = None
+
+    def reset(self):
+        self.state = self._initial_state(self.n_envs)
+        self._steps[:] = 0
+        observations = self._observation(self.state)
+        return lambda: observations
+
+    def step(self, actions):
+        rewards, dones = self._step(np.asarray(actions))
+        self._steps += 1
+        # Time limit, the same as gym's TimeLimit wrapper
+        dones |= self._steps >= self._max_steps
+        next_states = self._observation(self.state)
+
+        states = next_states
+        if dones.any():
+            self.state[dones] = self._initial_state(np.count_nonzero(dones))
+            self._steps[dones] = 0
+            states = self._observation(self.state)
+        return lambda: (next_states, rewards, dones, states)
+
+    def render(self):
+        return
+
+    def close(self):
+        return
+
+
+class VectorCartPole(VectorEnv):
+    """ CartPole-v1 """
+
+    gravity = 9.8
+    masscart = 1.0
+    masspole = 0.1
+    total_mass = masspole + masscart
+    length = 0.5
+    polemass_length = masspole * length
+    force_mag = 10.0
+    tau = 0.02
+    theta_threshold_radians = 12 * 2 * math.pi / 360
+    x_threshold = 2.4
+
+    def __init__(self, count, seed=None):
+        super().__init__("CartPole-v1", count, max_steps=500, seed=seed)
+
+    def _initial_state(self, count):
+        return self._rng.uniform(low=-0.05, high=0.05, size=(count, 4))
+
+    def _observation(self, state):
+        return state.astype(np.float32)
+
+    def _step(self, actions):
+        x, x_dot, theta, theta_dot = self.state.T
+        force = np.where(actions == 1, self.force_mag, -self.force_mag)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+
+        temp = (force + self.polemass_length * theta_dot ** 2 * sintheta) / \
+            self.total_mass
+        thetaacc = (self.gravity * sintheta - costheta * temp) / (
+                self.length * (4.0 / 3.0 - self.masspole * costheta ** 2 /
+                               self.total_mass))
+        xacc = temp - self.polemass_length * thetaacc * costheta / \
+            self.total_mass
+
+        self.state = np.stack([
+            x + self.tau * x_dot,
+            x_dot + self.tau * xacc,
+            theta + self.tau * theta_dot,
+            theta_dot + self.tau * thetaacc,
+        ], axis=1)
+
+        x = self.state[:, 0]
+        theta = self.state[:, 2]
+        dones = (np.abs(x) > self.x_threshold) | \
+            (np.abs(theta) > self.theta_threshold_radians)
+        rewards = np.ones(self.n_envs, dtype=np.float32)
+        return rewards, dones
+
+
+class VectorMountainCar(VectorEnv):
+    """ MountainCar-v0 """
+
+    min_position = -1.2
+    max_position = 0.6
+    max_speed = 0.07
+    goal_position = 0.5
+    goal_velocity = 0
+    force = 0.001
+    gravity = 0.0025
+
+    def __init__(self, count, seed=None):
+        super().__init__("MountainCar-v0", count, max_steps=200, seed=seed)
+
+    def _initial_state(self, count):
+        return np.stack([
+            self._rng.uniform(low=-0.6, high=-0.4, size=count),
+            np.zeros(count),
+        ], axis=1)
+
+    def _observation(self, state):
+        return state.astype(np.float32)
+
+    def _step(self, actions):
+        position, velocity = self.state.T
+        velocity = velocity + (actions - 1) * self.force + \
+            np.cos(3 * position) * (-self.gravity)
+        velocity = np.clip(velocity, -self.max_speed, self.max_speed)
+        position = np.clip(
+                position + velocity, self.min_position, self.max_position)
+        velocity[(position == self.min_position) & (velocity < 0)] = 0
+
+        self.state = np.stack([position, velocity], axis=1)
+        dones = (position >= self.goal_position) & \
+            (velocity >= self.goal_velocity)
+        rewards = np.full(self.n_envs, -1.0, dtype=np.float32)
+        return rewards, dones
+
+
+class VectorPendulum(VectorEnv):
+    """ Pendulum-v0 """
+
+    max_speed = 8
+    max_torque = 2.
+    dt = .05
+    g = 10.0
+    m = 1.
+    l = 1.
+
+    def __init__(self, count, seed=None):
+        super().__init__("Pendulum-v0", count, max_steps=200, seed=seed)
+
+    def _initial_state(self, count):
+        high = np.array([np.pi, 1])
+        return self._rng.uniform(low=-high, high=high, size=(count, 2))
+
+    def _observation(self, state):
+        theta, thetadot = state.T
+        return np.stack(
+                [np.cos(theta), np.sin(theta), thetadot],
+                axis=1).astype(np.float32)
+
+    def _step(self, actions):
+        th, thdot = self.state.T
+        g, m, l, dt = self.g, self.m, self.l, self.dt
+
+        u = np.clip(actions, -self.max_torque, self.max_torque)[:, 0]
+        costs = angle_normalize(th) ** 2 + .1 * thdot ** 2 + .001 * (u ** 2)
+
+        newthdot = thdot + (
+                -3 * g / (2 * l) * np.sin(th + np.pi) +
+                3. / (m * l ** 2) * u) * dt
+        newth = th + newthdot * dt
+        newthdot = np.clip(newthdot, -self.max_speed, self.max_speed)
+
+        self.state = np.stack([newth, newthdot], axis=1)
+        rewards = (-costs).astype(np.float32)
+        dones = np.zeros(self.n_envs, dtype=np.bool_)
+        return rewards, dones
+
+
+def angle_normalize(x):
+    return (((x + np.pi) % (2 * np.pi)) - np.pi)
+
+
+vector_envs = {
+    "CartPole-v1": VectorCartPole,
+    "MountainCar-v0": VectorMountainCar,
+    "Pendulum-v0": VectorPendulum,
+}
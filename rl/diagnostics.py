@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class Diagnostics:
+    """ Decides when the agents compute their diagnostic statistics,
+    which cost extra work: gradient norms, noise levels, forward passes
+    only for the KL divergence.
+
+    Every site is sampled on its own, on each `every`-th call or, when
+    `interval` is set, at most once per `interval` seconds. The first call
+    of a site is always sampled, `every = 0` turns the diagnostics off.
+    Agents which share the process (MultiPPO sub-agents) prefix their
+    sites with their names, so they don't take each other's samples.
+    """
+
+    def __init__(self, every=1, interval=None):
+        self.every = every
+        self.interval = interval
+        self._calls = {}  # site → number of calls
+        self._last = {}  # site → time of the last sampled call
+        # Sub-agents may be optimized on several threads
+        self._lock = threading.Lock()
+
+    def due(self, site):
+        """ Whether the diagnostics of the site are computed this call """
+        with self._lock:
+            return self._due(site)
+
+    def _due(self, site):
+        if self.interval is not None:
+            now = time.time()
+            last = self._last.get(site)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last[site] = now
+            return True
+        if self.every <= 0:
+            return False
+        calls = self._calls.get(site, 0)
+        self._calls[site] = calls + 1
+        return calls % self.every == 0
+
+
+diagnostics = Diagnostics()
@@ -1,58 +1,222 @@
 import time
 import math
 import numpy as np
-from collections import namedtuple
-from multiprocessing import Process, Pipe, set_start_method
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Pipe, Semaphore
+from multiprocessing import get_start_method, set_start_method
+from multiprocessing.connection import wait
+from multiprocessing.sharedctypes import RawArray, RawValue
 
 import gym
 from gym import spaces
 from unityagents import UnityEnvironment
 
 from rl import Statistics
+from rl.profiler import profiler
+from rl.ppo import Net, SharedWeights, WorkerPolicy
+from rl.classic_control import vector_envs
+from rl.normalizer import ObservationNormalizer
+from rl.mock_unity import MockUnityEnvironment
 
 # Common code for both Unity and OpenAI environments
 
-def create_env(env_id, count=1):
-    set_start_method('spawn')
+def create_env(
+        env_id, count=1, envs_per_worker=0, min_ready_envs=0, spare_envs=0,
+        split=False, worker_policy=False, vectorized=False,
+        normalize_obs=False, train_mode=False, mock_unity=None):
+    if get_start_method(allow_none=True) is None:
+        set_start_method('spawn')
     assert count > 0
+    assert count % max(1, envs_per_worker) == 0, \
+        "Environments count should be divisible by envs_per_worker"
+    forked = envs_per_worker > 0 or (env_id in unity_envs and count > 1)
+    assert forked or not (
+            min_ready_envs or spare_envs or split or worker_policy), \
+        "Partial batches, split, spare environments and worker policy " + \
+        "need environments in worker processes"
+    assert not vectorized or (env_id in vector_envs and not forked), \
+        "Vectorized environments: {}".format(", ".join(vector_envs))
+    assert not (normalize_obs and worker_policy), \
+        "Running observation statistics are kept by the main process " + \
+        "and can't be used by the worker policy"
+    adapters_count = count
+    # Released by every worker which finished a step
+    any_ready = Semaphore(0) if min_ready_envs > 0 else None
+
+    normalizer = None
+    if env_id in observation_bounds and not normalize_obs:
+        low, high = observation_bounds[env_id]
+        normalizer = ObservationNormalizer(np.shape(low), low=low, high=high)
+
+    # Workers act with a copy of the PPO or IMPALA network
+    weights = None
+    policy = None
+    if worker_policy:
+        observation_space, action_space = env_spaces(env_id)
+        weights = SharedWeights(Net(observation_space.shape, action_space))
+        policy = (weights, observation_space.shape, action_space, normalizer)
 
     if env_id in unity_envs:
+        # mock_unity: MockUnityEnvironment arguments to run it instead of
+        # the Unity build
         render = count == 1
         fork = count > 1
         if fork:
-            create_env_fn = lambda: ForkedUnityEnv(env_id, render=render)
+            # Unity environments always run in worker processes
+            per_worker = max(1, envs_per_worker)
+            adapters_count = count // per_worker
+            create_env_fn = lambda: ForkedUnityEnv(
+                    env_id,
+                    count=per_worker,
+                    spares=spare_envs,
+                    render=render,
+                    train_mode=train_mode,
+                    mock=mock_unity,
+                    any_ready=any_ready,
+                    policy=policy)
         else:
             create_env_fn = lambda: _run_unity_env(
                     env_id,
                     render=render,
-                    worker_id=0)
+                    worker_id=0,
+                    train_mode=train_mode,
+                    mock=mock_unity)
+    elif vectorized:
+        # All the environments are stepped at once in the main process
+        adapters_count = 1
+        create_env_fn = lambda: vector_envs[env_id](count)
+    elif envs_per_worker > 0:
+        adapters_count = count // envs_per_worker
+        create_env_fn = lambda: ForkedGymEnv(
+                env_id,
+                count=envs_per_worker,
+                spares=spare_envs,
+                any_ready=any_ready,
+                policy=policy)
     else:
         create_env_fn = lambda: OpenAIAdapter(env_id)
 
-    env = MultiEnv(create_env_fn, count=count)
+    env = MultiEnv(
+            create_env_fn,
+            count=adapters_count,
+            min_ready=min_ready_envs,
+            any_ready=any_ready,
+            split=split,
+            weights=weights)
+    if normalize_obs:
+        normalizer = ObservationNormalizer(env.observation_space.shape)
+        print("Observations are normalized by running mean and variance")
+    env.normalizer = normalizer
 
     print("Created {} environment. Instances: {}".format(env_id, count))
     return env
 
 
 class MultiEnv(object):
-    """ Simulates mutliple simultaneously running environments """
+    """ Simulates mutliple simultaneously running environments.
+
+    `states` are the states to act on, `rows` are their indices in the
+    full batch of n_envs * n_agents rows. After a step `completed` holds
+    (rows, states, actions, log_probs) of the returned transitions,
+    log_probs are None unless the workers act.
+
+    With min_ready > 0 the environments are stepped asynchronously: a step
+    returns as soon as at least min_ready workers have finished, so `rows`
+    is a subset of the full batch which changes from step to step. The
+    rest of the workers keep running with the actions they have got.
+
+    With split=True the workers are divided into two halves which take
+    turns: a step sends the actions to one half and returns the results of
+    the other, so the agent acts on a half while the other one simulates.
+    The first step after a reset returns no transitions.
 
-    def __init__(self, create_env_fn, count):
+    With weights (SharedWeights) the workers act themselves: step() takes
+    None instead of the actions and the actions come back in `completed`
+    along with their log probabilities under the workers' policy.
+
+    With a normalizer (ObservationNormalizer) all the returned states are
+    normalized, the batch of the next states updates its statistics.
+
+    `states` is a new array after every step and reset, so it can be kept
+    without a copy.
+    """
+
+    def __init__(
+            self, create_env_fn, count, min_ready=0, any_ready=None,
+            split=False, weights=None, startup_timeout=600.):
         assert count > 0
+        # Worker processes start concurrently, the handshakes are
+        # collected after all of them have been launched
         self._envs = [create_env_fn() for _ in range(count)]
+        connect_envs(
+                [env for env in self._envs if isinstance(env, ForkedEnv)],
+                startup_timeout)
         self.action_space = self._envs[0].action_space
         self.observation_space = self._envs[0].observation_space
         self.n_agents = self._envs[0].n_agents
 
+        bounds = np.cumsum(
+                [0] + [env.n_envs * env.n_agents for env in self._envs])
+        self._env_rows = [
+            np.arange(start, end)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        # Episodes of all the environment instances are tracked together
+        bounds = np.cumsum([0] + [env.n_instances for env in self._envs])
+        self._env_instances = [
+            np.arange(start, end)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        self._instance_rows = len(self._env_rows[0]) // \
+            self._envs[0].n_instances
+
+        self._min_ready = min_ready
+        self._any_ready = any_ready
+        self._weights = weights
+        self.normalizer = None
+        self._pending = {}  # env_idx → (states, actions) of running steps
+        if self._min_ready > 0:
+            assert self._min_ready <= count
+            assert all([env.auto_reset for env in self._envs])
+            print("Partial batches: at least {} of {} workers".format(
+                self._min_ready, count))
+
+        self._groups = None
+        if split:
+            assert self._min_ready == 0 and count >= 2
+            assert all([env.auto_reset for env in self._envs])
+            self._groups = [
+                list(range(count // 2)), list(range(count // 2, count))]
+            print("Workers are split into groups of {} and {}".format(
+                len(self._groups[0]), len(self._groups[1])))
+
     @property
     def n_envs(self):
         return sum([env.n_envs for env in self._envs])
 
-    def step(self, actions):
-        stats = Statistics()
+    @property
+    def partial(self):
+        return self._min_ready > 0 or self._groups is not None
+
+    @property
+    def worker_policy(self):
+        return self._weights is not None
+
+    def publish(self, net):
+        """ Sends new weights to the workers which act themselves """
+        self._weights.write(net)
+
+    def step(self, actions, stats=None):
+        """ stats: Statistics to add the statistics of the step to,
+        the new ones by default """
+        if stats is None:
+            stats = Statistics()
+        if self.partial:
+            return self._step_partial(actions, stats)
 
         t0 = time.time()
+        self.completed = (self.rows, self.states, actions, None)
         next_states = []
         states = []
         rewards = []
@@ -65,25 +229,22 @@ class MultiEnv(object):
             count = env.n_envs * env.n_agents
             start = env_idx * count
             end = start + count
-            env_actions = actions[start:end]
+            env_actions = None if actions is None else actions[start:end]
             step_promises.append(env.step(env_actions))
 
         reset_states = []
         for env_idx, step_promise in enumerate(step_promises):
-            env_next_states, env_rewards, env_dones = step_promise()
-
             env = self._envs[env_idx]
-            env_states = env_next_states
-            env_stat = self._env_stats[env]
-            env_stat.set("steps", 1)
-            env_stat.set("rewards", sum(env_rewards))
-            if env_dones.any():
-                stats.set("steps", env_stat.sum("steps"))
-                avg_reward = env_stat.sum("rewards") / (
-                        env.n_envs * env.n_agents)
-                stats.set("rewards", avg_reward)
-                stats.set("episodes", 1)
-                self._env_stats[env] = Statistics()
+            if env.auto_reset:
+                # States after the reset are returned by the environment
+                env_next_states, env_rewards, env_dones, env_states = \
+                    step_promise()
+            else:
+                env_next_states, env_rewards, env_dones = step_promise()
+                env_states = env_next_states
+
+            self._worker_stats(env_idx, stats)
+            if not env.auto_reset and env_dones.any():
                 reset_states.append((env_idx, env.reset()))
 
             next_states.append(env_next_states)
@@ -94,20 +255,217 @@ class MultiEnv(object):
         for env_idx, step_promise in reset_states:
             states[env_idx] = step_promise()
 
+        if actions is None:
+            acted = [env.acted() for env in self._envs]
+            self.completed = (
+                    self.rows,
+                    self._normalize(
+                        np.concatenate([s for s, _, _ in acted], axis=0)),
+                    np.concatenate([a for _, a, _ in acted], axis=0),
+                    np.concatenate([p for _, _, p in acted], axis=0))
+
+        rewards = np.concatenate(rewards, axis=0)
+        dones = np.concatenate(dones, axis=0)
+        next_states = self._normalize(
+                np.concatenate(next_states, axis=0), update=True)
+        self.states = self._normalize(np.concatenate(states, axis=0))
+        self._track_episodes(self._all_instances, rewards, dones, stats)
+
+        stats.set("env_time", time.time() - t0)
+
+        return rewards, next_states, dones, stats
+
+    def _step_partial(self, actions, stats):
+        t0 = time.time()
+
+        # Dispatch the actions to the environments which states were given
+        start = 0
+        for env_idx in self._ready:
+            end = start + len(self._env_rows[env_idx])
+            if actions is None:
+                self._envs[env_idx].step(None)
+                self._pending[env_idx] = None
+            else:
+                self._envs[env_idx].step(actions[start:end])
+                self._pending[env_idx] = (
+                        self.states[start:end], actions[start:end], None)
+            start = end
+
+        if self._groups is None:
+            self._ready = self._wait_ready(self._min_ready)
+        else:
+            self._ready = self._wait_group(stats)
+        rows = []
+        instances = []
+        completed_rows = []
+        completed_states = []
+        completed_actions = []
+        completed_log_probs = []
+        next_states = []
+        states = []
+        rewards = []
+        dones = []
+        for env_idx in self._ready:
+            rows.append(self._env_rows[env_idx])
+            if env_idx in self._initial_states:
+                # Not stepped since the reset
+                states.append(self._initial_states.pop(env_idx))
+                continue
+
+            env_next_states, env_rewards, env_dones, env_states = \
+                self._envs[env_idx].step_result()
+            self._worker_stats(env_idx, stats)
+            instances.append(self._env_instances[env_idx])
+            acted = self._pending.pop(env_idx)
+            if acted is None:
+                acted = [np.copy(x) for x in self._envs[env_idx].acted()]
+            env_completed_states, env_actions, env_log_probs = acted
+
+            completed_rows.append(self._env_rows[env_idx])
+            completed_states.append(env_completed_states)
+            completed_actions.append(env_actions)
+            completed_log_probs.append(env_log_probs)
+            next_states.append(env_next_states)
+            states.append(env_states)
+            rewards.append(env_rewards)
+            dones.append(env_dones)
+
+        if len(completed_rows) == 0:
+            # Empty arrays of the right shapes and types
+            completed_rows.append(rows[0][:0])
+            instances.append(self._all_instances[:0])
+            completed_states.append(self.states[:0])
+            completed_actions.append(np.zeros(
+                (0,) + self.action_space.shape, dtype=self.action_space.dtype))
+            completed_log_probs.append(np.zeros(0, dtype=np.float32))
+            next_states.append(self.states[:0])
+            rewards.append(np.zeros(0, dtype=np.float32))
+            dones.append(np.zeros(0, dtype=np.bool_))
+
+        completed_states = np.concatenate(completed_states, axis=0)
+        if self.worker_policy:
+            # The workers act on the raw states
+            completed_states = self._normalize(completed_states)
+            completed_log_probs = np.concatenate(completed_log_probs, axis=0)
+        else:
+            completed_log_probs = None
+        self.completed = (
+                np.concatenate(completed_rows, axis=0),
+                completed_states,
+                np.concatenate(completed_actions, axis=0),
+                completed_log_probs)
+        self.rows = np.concatenate(rows, axis=0)
+        self.states = self._normalize(np.concatenate(states, axis=0))
         rewards = np.concatenate(rewards, axis=0)
         dones = np.concatenate(dones, axis=0)
-        next_states = np.concatenate(next_states, axis=0)
-        self.states = np.concatenate(states, axis=0)
+        next_states = self._normalize(
+                np.concatenate(next_states, axis=0), update=True)
+        self._track_episodes(
+                np.concatenate(instances, axis=0), rewards, dones, stats)
 
         stats.set("env_time", time.time() - t0)
+        stats.set("ready_envs", len(self._ready))
 
         return rewards, next_states, dones, stats
 
+    def _normalize(self, states, update=False):
+        if self.normalizer is None:
+            return states
+        return self.normalizer(states, update=update)
+
+    def _wait_ready(self, min_count):
+        """ Indices of the environments which finished their steps.
+        Blocks until at least min_count of them are ready. """
+        ready = []
+        while len(ready) < len(self._pending):
+            # Every finished step releases any_ready once after its own
+            # response, so a token means one more environment is ready.
+            if not self._any_ready.acquire(len(ready) < min_count):
+                break
+            for env_idx in self._pending:
+                if env_idx not in ready and self._envs[env_idx].poll():
+                    ready.append(env_idx)
+                    break
+        return ready
+
+    def _wait_group(self, stats):
+        """ Waits for the group which wasn't given the actions.
+        Overlap is the part of the workers' simulation time which the
+        main process spent on something else than waiting for them. """
+        group = self._groups[1] if self._ready == self._groups[0] \
+            else self._groups[0]
+        t0 = time.time()
+        simulation_time = 0.
+        for env_idx in group:
+            if env_idx in self._pending:
+                self._envs[env_idx].poll(block=True)
+                simulation_time = max(
+                        simulation_time, self._envs[env_idx].step_time)
+        wait_time = time.time() - t0
+        if simulation_time > 0:
+            stats.set("env_overlap", max(
+                0., 1. - wait_time / simulation_time))
+        return group
+
+    def _drain(self):
+        """ Waits for the running steps and drops their results """
+        for env_idx in self._pending:
+            self._envs[env_idx].poll(block=True)
+            if self._any_ready is not None:
+                self._any_ready.acquire()
+        self._pending.clear()
+
+    def _worker_stats(self, env_idx, stats):
+        """ Step time of the worker process, as measured by itself """
+        env = self._envs[env_idx]
+        if not isinstance(env, ForkedEnv):
+            return
+        stats.set("worker_step_time/{}".format(env_idx), env.step_time)
+        profiler.event(
+                "env_step", env.step_start, env.step_time,
+                track="worker {}".format(env_idx))
+
+    def _track_episodes(self, instances, rewards, dones, stats):
+        """ Accumulates steps and rewards of the running episodes.
+        Episode of an environment instance ends when any of its
+        sub-environments or agents is done. """
+        rewards = np.reshape(rewards, (-1, self._instance_rows))
+        finished = np.reshape(dones, (-1, self._instance_rows)).any(axis=1)
+        self._episode_steps[instances] += 1
+        self._episode_rewards[instances] += rewards.sum(axis=1)
+        if not finished.any():
+            return
+        finished = instances[finished]
+        for steps, episode_rewards in zip(
+                self._episode_steps[finished],
+                self._episode_rewards[finished]):
+            stats.set("steps", int(steps))
+            stats.set("rewards", episode_rewards / self._instance_rows)
+            stats.set("episodes", 1)
+        self._episode_steps[finished] = 0
+        self._episode_rewards[finished] = 0.
+
     def reset(self):
-        self._env_stats = {env: Statistics() for env in self._envs}
+        self._drain()
+        n_instances = sum([env.n_instances for env in self._envs])
+        self._all_instances = np.arange(n_instances)
+        self._episode_steps = np.zeros(n_instances, dtype=np.int64)
+        self._episode_rewards = np.zeros(n_instances)
         step_promises = [env.reset() for env in self._envs]
-        states = [step_promise() for step_promise in step_promises]
-        self.states = np.concatenate(states, axis=0)
+        states = [np.copy(step_promise()) for step_promise in step_promises]
+
+        self._ready = list(range(len(self._envs)))
+        self._initial_states = {}
+        if self._groups is not None:
+            # The second group gets its actions after the first step
+            self._ready = self._groups[0]
+            self._initial_states = {
+                env_idx: states[env_idx] for env_idx in self._groups[1]}
+        self.rows = np.concatenate(
+                [self._env_rows[env_idx] for env_idx in self._ready], axis=0)
+        self.states = self._normalize(np.concatenate(
+                [states[env_idx] for env_idx in self._ready], axis=0),
+                update=True)
 
     def render(self):
         if len(self._envs) == 1:
@@ -119,17 +477,21 @@ class MultiEnv(object):
 
 # OpenAI Environments
 
+# Observations of these environments are rescaled to [-1, 1] by default
+observation_bounds = {
+    "CartPole-v1": (
+        [-2.4, -5., -math.pi/12., -math.pi*2.],
+        [2.4, 5., math.pi/12., math.pi*2.]),
+}
+
 
 class OpenAIAdapter:
 
+    n_instances = 1
+    auto_reset = False
+
     def __init__(self, env_id):
         env = gym.make(env_id)
-
-        if env_id == "CartPole-v1":
-            min_vals = np.array([-2.4, -5., -math.pi/12., -math.pi*2.])
-            max_vals = np.array([2.4, 5., math.pi/12., math.pi*2.])
-            env = WrapNormalizeState(env, min_vals, max_vals)
-
         self._env = env
 
         self.n_envs = 1
@@ -157,26 +519,324 @@ class OpenAIAdapter:
         self._env.render()
 
 
-class WrapNormalizeState(gym.ObservationWrapper):
+class ForkedEnv:
+    """ Environments in a worker process. Subclasses start the worker,
+    connect() takes the worker's handshake once it has started. """
+
+    def connect(self, info):
+        return
+
+    def step(self, actions):
+        return self._worker.step(actions)
+
+    def poll(self, block=False):
+        """ Whether the worker finished the step. Once it returns True
+        the result is available through step_result(). """
+        return self._worker.poll(block)
+
+    @property
+    def step_time(self):
+        """ Duration of the last step in the worker, seconds """
+        return float(self._worker.buffers.step_time[0])
+
+    @property
+    def step_start(self):
+        """ When the worker started the last step, seconds since epoch """
+        return float(self._worker.buffers.step_start[0])
+
+    def step_result(self):
+        return self._worker.result()
+
+    def acted(self):
+        """ States, actions and their log probabilities of the last step
+        when the worker acts """
+        b = self._worker.buffers
+        return b.acted_states, b.actions, b.log_probs
+
+    def reset(self):
+        return self._worker.reset()
+
+    def render(self):
+        self._worker.render()
+
+    def close(self):
+        self._worker.close()
+
+
+class ForkedGymEnv(ForkedEnv):
+    """ Runs several OpenAI Gym environments in a worker process.
+
+    Actions, observations, rewards and dones are exchanged through shared
+    memory. Environments which finished an episode are reset by the worker
+    and their initial states are returned along with the terminal ones.
+    """
+
+    n_agents = 1
+    auto_reset = True
+
+    def __init__(self, env_id, count, spares=0, any_ready=None, policy=None):
+        probe = OpenAIAdapter(env_id)
+        self.action_space = probe.action_space
+        self.observation_space = probe.observation_space
+        probe.close()
+
+        self.n_envs = count
+        self.n_instances = count
+        self._worker = EnvWorker(
+                _run_forked_gym_env,
+                (env_id, count, spares, policy),
+                env_buffers(
+                    count,
+                    self.observation_space.shape,
+                    self.action_space.shape,
+                    self.action_space.dtype),
+                any_ready=any_ready)
+
 
-    def __init__(self, env, min_value, max_value):
-        super(WrapNormalizeState, self).__init__(env)
-        self.min_value = min_value
-        self.max_value = max_value
+def _run_forked_gym_env(
+        env_id, count, spares, policy, pipe, buffers, channel):
+    envs = [OpenAIAdapter(env_id) for _ in range(count + spares)]
+    if policy is not None:
+        policy = WorkerPolicy(*policy)
+    pipe.send("READY")
+    serve_envs(
+            envs[:count], buffers, channel, True,
+            spares=envs[count:], policy=policy)
 
-    def observation(self, observation):
-        x = np.array(observation)
-        x -= self.min_value
-        x /= (self.max_value - self.min_value) # we hope no division by zero here, and this formula is more correct for rescaling, bro.
-        x = 2.0 * x - 1.0  # Rescale in range [-1, 1].
-        return x
+
+# Worker processes stepping environments in the shared memory
+
+STEP, RESET, RENDER, CLOSE, ACT = range(5)
+
+
+class EnvWorker:
+    """ Main process side of a worker process which hosts environments.
+
+    Commands are passed with a shared command slot and a pair of semaphores,
+    the data with SharedArrays, so a step costs a memcpy instead of pickling.
+    The pipe is used only for the startup handshake.
+    """
+
+    def __init__(self, target, args, buffers, daemon=True, any_ready=None):
+        self.buffers = buffers
+        self._channel = WorkerChannel(any_ready)
+        self.pipe, worker_pipe = Pipe()
+        self._process = Process(
+                target=target,
+                args=args + (worker_pipe, buffers, self._channel))
+        self._process.daemon = daemon
+        self.start_time = time.time()
+        self._process.start()
+
+    def handshake(self):
+        """ Waits for the worker to create its environments """
+        return self.pipe.recv()
+
+    def terminate(self):
+        self._process.terminate()
+
+    def step(self, actions):
+        """ actions: None if the worker acts itself """
+        if actions is None:
+            self._channel.send(ACT)
+        else:
+            self.buffers.actions[:] = actions
+            self._channel.send(STEP)
+        return self._step_result
+
+    def _step_result(self):
+        self._channel.response.acquire()
+        return self.result()
+
+    def poll(self, block=False):
+        return self._channel.response.acquire(block)
+
+    def result(self):
+        b = self.buffers
+        return b.next_states, b.rewards, b.dones, b.states
+
+    def reset(self):
+        self._channel.send(RESET)
+        return self._reset_result
+
+    def _reset_result(self):
+        self._channel.response.acquire()
+        return self.buffers.states
+
+    def render(self):
+        self._channel.send(RENDER)
+
+    def close(self):
+        self._channel.send(CLOSE)
+
+
+def connect_envs(envs, timeout):
+    """ Collects the handshakes of the forked environments in the order
+    the workers come up. Fails if they haven't all started in time. """
+    pending = {env._worker.pipe: env for env in envs}
+    deadline = time.time() + timeout
+    while pending:
+        ready = wait(list(pending), max(0., deadline - time.time()))
+        if not ready:
+            for env in pending.values():
+                env._worker.terminate()
+            raise TimeoutError(
+                    "{} of {} workers didn't start in {:.0f} seconds".format(
+                        len(pending), len(envs), timeout))
+        for pipe in ready:
+            env = pending.pop(pipe)
+            env.connect(pipe.recv())
+            print("Worker {} of {} started in {:.1f} seconds".format(
+                len(envs) - len(pending), len(envs),
+                time.time() - env._worker.start_time))
+
+
+class WorkerChannel:
+    """ Command slot and semaphores shared with a worker process """
+
+    def __init__(self, any_ready=None):
+        self.command = RawValue('i', STEP)
+        self.request = Semaphore(0)
+        self.response = Semaphore(0)
+        self.any_ready = any_ready
+
+    def send(self, command):
+        self.command.value = command
+        self.request.release()
+
+
+def env_buffers(rows, state_shape, action_shape, action_dtype):
+    return SharedArrays({
+        "actions": ((rows,) + action_shape, action_dtype),
+        "states": ((rows,) + state_shape, np.float32),
+        # States which the worker acted on
+        "acted_states": ((rows,) + state_shape, np.float32),
+        # Log probabilities of the actions the worker picked
+        "log_probs": ((rows,), np.float32),
+        "next_states": ((rows,) + state_shape, np.float32),
+        "rewards": ((rows,), np.float32),
+        "dones": ((rows,), np.bool_),
+        "step_time": ((1,), np.float64),
+        "step_start": ((1,), np.float64),
+    })
+
+
+def serve_envs(envs, buffers, channel, auto_reset, spares=(), policy=None):
+    """ Command loop of a worker process. Every environment owns
+    n_envs * n_agents consecutive rows of the buffers.
+
+    Spare environments are reset in a background thread. When an episode
+    ends, the finished environment is swapped with a ready spare one and
+    is reset in the background, so the step doesn't wait for the reset.
+
+    With a policy (WorkerPolicy) the worker picks the actions itself.
+    """
+    bounds = np.cumsum([0] + [env.n_envs * env.n_agents for env in envs])
+    rows = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+    envs = list(envs)
+
+    resetter = None
+    spare_resets = deque()
+    if spares:
+        resetter = ThreadPoolExecutor(max_workers=1)
+        spare_resets.extend([
+            resetter.submit(_reset_spare, env) for env in spares])
+
+    while True:
+        try:
+            channel.request.acquire()
+            command = channel.command.value
+            if command == RESET:
+                promises = [env.reset() for env in envs]
+                for env_rows, promise in zip(rows, promises):
+                    buffers.states[env_rows] = promise()
+                channel.response.release()
+            elif command == CLOSE:
+                [env.close() for env in envs]
+                for spare_reset in spare_resets:
+                    spare_reset.result()[0].close()
+                return
+            elif command == RENDER:
+                envs[0].render()
+            else:
+                t0 = time.time()
+                buffers.step_start[0] = t0
+                if command == ACT:
+                    buffers.acted_states[:] = buffers.states
+                    buffers.actions[:], buffers.log_probs[:] = \
+                        policy.act(buffers.states)
+                promises = [
+                    env.step(buffers.actions[env_rows])
+                    for env, env_rows in zip(envs, rows)
+                ]
+                for idx, (env_rows, promise) in enumerate(zip(rows, promises)):
+                    next_states, rewards, dones = promise()
+                    buffers.next_states[env_rows] = next_states
+                    buffers.rewards[env_rows] = rewards
+                    buffers.dones[env_rows] = dones
+                    if auto_reset and dones.any() and spare_resets:
+                        spare, states = spare_resets.popleft().result()
+                        spare_resets.append(
+                                resetter.submit(_reset_spare, envs[idx]))
+                        envs[idx] = spare
+                        buffers.states[env_rows] = states
+                    elif auto_reset and dones.any():
+                        buffers.states[env_rows] = envs[idx].reset()()
+                    else:
+                        buffers.states[env_rows] = next_states
+                buffers.step_time[0] = time.time() - t0
+                channel.response.release()
+                if channel.any_ready is not None:
+                    channel.any_ready.release()
+        except KeyboardInterrupt:
+            pass
+
+
+def _reset_spare(env):
+    return env, env.reset()()
+
+
+class SharedArrays:
+    """ Numpy arrays in the shared memory. Created in the main process and
+    passed to a worker process as an argument on its start. """
+
+    def __init__(self, specs):
+        """ specs: name → (shape, dtype) """
+        self._specs = specs
+        self._buffers = {
+            name: RawArray('b', max(1, _nbytes(shape, dtype)))
+            for name, (shape, dtype) in specs.items()
+        }
+        self._wrap()
+
+    def _wrap(self):
+        for name, (shape, dtype) in self._specs.items():
+            array = np.frombuffer(
+                    self._buffers[name],
+                    dtype=dtype,
+                    count=int(np.prod(shape)))
+            setattr(self, name, array.reshape(shape))
+
+    def __getstate__(self):
+        return self._specs, self._buffers
+
+    def __setstate__(self, state):
+        self._specs, self._buffers = state
+        self._wrap()
+
+
+def _nbytes(shape, dtype):
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
 
 
 # Unity Environments
 
 
+# Observation and action sizes are needed to allocate the shared memory
+# before a worker process starts the environment.
 UnityEnvConfig = namedtuple("UnityEnvConfig", [
-    "id", "path", "path_novis", "n_agents", "n_envs"])
+    "id", "path", "path_novis", "n_agents", "n_envs",
+    "observation_size", "action_size", "action_type"])
 
 unity_env_list = {
         UnityEnvConfig(
@@ -185,6 +845,9 @@ unity_env_list = {
             path_novis="Banana_Linux_NoVis/Banana.x86_64",
             n_agents=1,
             n_envs=1,
+            observation_size=37,
+            action_size=4,
+            action_type="discrete",
         ),
         UnityEnvConfig(
             id="reachersingle",
@@ -192,6 +855,9 @@ unity_env_list = {
             path_novis="Reacher_Linux_single_NoVis/Reacher.x86_64",
             n_agents=1,
             n_envs=1,
+            observation_size=33,
+            action_size=4,
+            action_type="continuous",
         ),
         UnityEnvConfig(
             id="reacher",
@@ -199,6 +865,9 @@ unity_env_list = {
             path_novis="Reacher_Linux_NoVis/Reacher.x86_64",
             n_agents=1,
             n_envs=20,
+            observation_size=33,
+            action_size=4,
+            action_type="continuous",
         ),
         UnityEnvConfig(
             id="crawler",
@@ -206,6 +875,9 @@ unity_env_list = {
             path_novis="Crawler_Linux_NoVis/Crawler.x86_64",
             n_agents=1,
             n_envs=12,
+            observation_size=129,
+            action_size=20,
+            action_type="continuous",
         ),
         UnityEnvConfig(
             id="tennis",
@@ -213,94 +885,126 @@ unity_env_list = {
             path_novis="Tennis_Linux_NoVis/Tennis.x86_64",
             n_agents=2,
             n_envs=1,
+            observation_size=24,
+            action_size=2,
+            action_type="continuous",
         ),
 }
 
 unity_envs = {env.id: env for env in unity_env_list}
 
 
-class ForkedUnityEnv:
+class ForkedUnityEnv(ForkedEnv):
+    """ Runs several Unity environments in a worker process. The worker
+    steps them one after another and resets the finished ones. """
 
     last_unity_worker_id = 0
+    auto_reset = True
 
-    def __init__(self, env_id, render=False):
+    def __init__(
+            self, env_id, count=1, spares=0, render=False, train_mode=False,
+            mock=None, any_ready=None, policy=None):
         self._config = unity_envs[env_id]
-        traj_pipe_in, traj_pipe_out = Pipe(duplex=False)
-        action_pipe_in, action_pipe_out = Pipe(duplex=False)
-
-        self._traj_pipe = traj_pipe_in
-        self._action_pipe = action_pipe_out
+        self.n_instances = count
+        rows = self._config.n_envs * self._config.n_agents * count
+        if self._config.action_type == "continuous":
+            action_shape = (self._config.action_size,)
+            action_dtype = np.float32
+        else:
+            action_shape = ()
+            action_dtype = np.int64
 
-        p = Process(
-                target=_run_forked_unity_env,
-                args=(
+        self._worker = EnvWorker(
+                _run_forked_unity_env,
+                (
                     env_id,
-                    action_pipe_in,
-                    traj_pipe_out,
                     render,
-                    ForkedUnityEnv.last_unity_worker_id))
-        p.start()
-        ForkedUnityEnv.last_unity_worker_id += 1
-
-        env_info = self._traj_pipe.recv()
+                    train_mode,
+                    mock,
+                    ForkedUnityEnv.last_unity_worker_id,
+                    count,
+                    spares,
+                    policy),
+                env_buffers(
+                    rows,
+                    (self._config.observation_size,),
+                    action_shape,
+                    action_dtype),
+                daemon=False,
+                any_ready=any_ready)
+        # Every Unity instance needs its own port
+        ForkedUnityEnv.last_unity_worker_id += count + spares
+
+    def connect(self, env_info):
         self.observation_space = env_info["observation_space"]
         self.action_space = env_info["action_space"]
         self.n_agents = env_info["n_agents"]
-        self.n_envs = env_info["n_envs"]
-
-    def step(self, actions):
-        self._action_pipe.send(actions)
-        return self._traj_pipe.recv
-
-    def reset(self):
-        self._action_pipe.send("RESET")
-        return self._traj_pipe.recv
-
-    def render(self):
-        self._action_pipe.send("RENDER")
-
-    def close(self):
-        self._action_pipe.send("CLOSE")
-
-
-def _run_forked_unity_env(env_id, action_pipe, traj_pipe, render, worker_id):
-    env = _run_unity_env(env_id, worker_id=worker_id, render=render)
-
-    traj_pipe.send({
+        self.n_envs = env_info["n_envs"] * self.n_instances
+
+
+def _run_forked_unity_env(
+        env_id, render, train_mode, mock, worker_id, count, spares, policy,
+        pipe, buffers, channel):
+    envs = [
+        _run_unity_env(
+            env_id,
+            worker_id=worker_id + idx,
+            render=render,
+            train_mode=train_mode,
+            mock=mock)
+        for idx in range(count + spares)
+    ]
+    if policy is not None:
+        policy = WorkerPolicy(*policy)
+
+    env = envs[0]
+    pipe.send({
         "observation_space": env.observation_space,
         "action_space": env.action_space,
         "n_agents": env.n_agents,
         "n_envs": env.n_envs,
     })
+    serve_envs(
+            envs[:count], buffers, channel, True,
+            spares=envs[count:], policy=policy)
 
-    while True:
-        try:
-            action = action_pipe.recv()
-            if action == "RESET":
-                state_promise = env.reset()
-                state = state_promise()
-                traj_pipe.send(state)
-            elif action == "CLOSE":
-                env.close()
-                return
-            elif action == "RENDER":
-                env.render()
-            else:
-                step_promise = env.step(action)
-                step = step_promise()
-                traj_pipe.send(step)
-        except KeyboardInterrupt:
-            pass
+
+def env_spaces(env_id):
+    """ Observation and action spaces without starting the environment """
+    if env_id not in unity_envs:
+        env = gym.make(env_id)
+        env.close()
+        return env.observation_space, env.action_space
+
+    config = unity_envs[env_id]
+    observation_space = spaces.Box(
+            low=-100.0, high=100.0, shape=(config.observation_size,))
+    if config.action_type == "continuous":
+        action_space = spaces.Box(
+                low=-1.0, high=1.0, shape=(config.action_size,))
+    else:
+        action_space = spaces.Discrete(config.action_size)
+    return observation_space, action_space
 
 
-def _run_unity_env(env_id, worker_id, render=False):
+def _run_unity_env(
+        env_id, worker_id, render=False, train_mode=False, mock=None):
     config = unity_envs[env_id]
-    return UnityEnvAdapter(config, render=render, worker_id=worker_id)
+    return UnityEnvAdapter(
+            config, render=render, worker_id=worker_id,
+            train_mode=train_mode, mock=mock)
 
 
 class UnityEnvAdapter:
+    """ With train_mode the environment runs with the training time scale
+    and the low quality settings of the build, otherwise in real time.
+    mock: MockUnityEnvironment arguments to run it instead of the build.
+    """
 
-    def __init__(self, config, render, worker_id):
+    n_instances = 1
+    auto_reset = False
+
+    def __init__(self, config, render, worker_id, train_mode=False, mock=None):
         self._config = config
 
         file_name = config.path
@@ -308,17 +1012,23 @@ class UnityEnvAdapter:
             file_name = config.path_novis
         file_name = "environments/{}".format(file_name)
 
-        self._env = UnityEnvironment(file_name=file_name, worker_id=worker_id)
+        if mock is not None:
+            self._env = MockUnityEnvironment(
+                    config, worker_id=worker_id, **mock)
+        else:
+            self._env = UnityEnvironment(
+                    file_name=file_name, worker_id=worker_id)
         self._brain_name = self._env.brain_names[0]
+        self._train_mode = train_mode
         print("Unity Environment Adapter:")
         print("\tUsing brain {}".format(self._brain_name))
+        print("\tTrain mode: {}".format(self._train_mode))
 
         # Number of actions
         brain = self._env.brains[self._brain_name]
 
-        state_size = brain.vector_observation_space_size
-        if config.id == "tennis":
-            state_size = 24  # Bugfix for the TennisBrain
+        # TennisBrain reports a wrong size, so it is taken from the config
+        state_size = config.observation_size
 
         if brain.vector_action_space_type == 'continuous':
             self.action_space = spaces.Box(
@@ -355,7 +1065,8 @@ class UnityEnvAdapter:
 
     def reset(self):
         """ return state """
-        env_info = self._env.reset(train_mode=False)[self._brain_name]
+        env_info = self._env.reset(
+                train_mode=self._train_mode)[self._brain_name]
         return lambda: env_info.vector_observations
 
     def render(self):
@@ -0,0 +1,158 @@
+import inspect
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+from rl import Statistics
+from rl.env import create_env
+
+STEP, RESET, RENDER, CLOSE = range(4)
+
+# Environments are created one at a time: the Unity worker ids, and so
+# the ports, are taken from a counter which isn't thread safe
+_create_lock = threading.Lock()
+
+
+class EnvServer:
+    """ Long-lived process which keeps the environments warm between
+    training runs.
+
+    A client sends the create_env() options and leases an environment
+    created with them. It's stepped by the server on the client's commands
+    and returns to the pool of idle environments when the client
+    disconnects, so the next run with the same options starts instantly.
+    """
+
+    def __init__(self, address):
+        self._listener = Listener(address, family="AF_UNIX")
+        self._lock = threading.Lock()
+        self._pools = {}  # options → idle environments
+        print("Environment server is listening on {}".format(address))
+
+    def preload(self, options):
+        with _create_lock:
+            env = create_env(**options)
+        self._release(options, env)
+
+    def serve_forever(self):
+        while True:
+            conn = self._listener.accept()
+            threading.Thread(
+                    target=self._serve, args=(conn,), daemon=True).start()
+
+    def close(self):
+        """ Closes the idle environments """
+        with self._lock:
+            pools = self._pools
+            self._pools = {}
+        for envs in pools.values():
+            for env in envs:
+                env.close()
+        self._listener.close()
+
+    def _serve(self, conn):
+        options = conn.recv()
+        env = self._lease(options)
+        try:
+            conn.send({
+                "action_space": env.action_space,
+                "observation_space": env.observation_space,
+                "n_agents": env.n_agents,
+                "n_envs": env.n_envs,
+                "partial": env.partial,
+                "normalizer": env.normalizer,
+            })
+            while True:
+                command, actions = conn.recv()
+                if command == STEP:
+                    rewards, next_states, dones, stats = env.step(actions)
+                    conn.send((
+                        rewards, next_states, dones, stats.get(stats.keys()),
+                        env.rows, env.states, env.completed))
+                elif command == RESET:
+                    env.reset()
+                    conn.send((env.rows, env.states))
+                elif command == RENDER:
+                    env.render()
+                elif command == CLOSE:
+                    break
+        except EOFError:
+            print("Client disconnected")
+        finally:
+            conn.close()
+            self._release(options, env)
+
+    def _lease(self, options):
+        t0 = time.time()
+        with self._lock:
+            pool = self._pools.get(_pool_key(options), [])
+            env = pool.pop() if pool else None
+        if env is None:
+            with _create_lock:
+                env = create_env(**options)
+        print("Leased {} in {:.1f} seconds".format(
+            options["env_id"], time.time() - t0))
+        return env
+
+    def _release(self, options, env):
+        with self._lock:
+            self._pools.setdefault(_pool_key(options), []).append(env)
+
+
+def _pool_key(options):
+    # All the arguments, so that the defaults given explicitly or not
+    # lead to the same pool
+    args = inspect.signature(create_env).bind(**options)
+    args.apply_defaults()
+    return repr(sorted(args.arguments.items()))
+
+
+class RemoteEnv:
+    """ MultiEnv leased from an EnvServer.
+
+    Every step is pickled through the socket to the server, which passes
+    it on to its worker processes, so it costs a round trip more than a
+    local MultiEnv. `python benchmark.py env_server` measures the
+    difference.
+    """
+
+    worker_policy = False
+
+    def __init__(self, address, **options):
+        assert not options.get("worker_policy"), \
+            "Worker policy can't be used with the environment server"
+        assert not options.get("normalize_obs"), \
+            "Running observation statistics can't be kept by " + \
+            "the environment server"
+        t0 = time.time()
+        self._conn = Client(address, family="AF_UNIX")
+        self._conn.send(options)
+        info = self._conn.recv()
+        self.action_space = info["action_space"]
+        self.observation_space = info["observation_space"]
+        self.n_agents = info["n_agents"]
+        self.n_envs = info["n_envs"]
+        self.partial = info["partial"]
+        self.normalizer = info["normalizer"]
+        print("Leased {} environment from {} in {:.1f} seconds".format(
+            options["env_id"], address, time.time() - t0))
+
+    def step(self, actions, stats=None):
+        self._conn.send((STEP, actions))
+        rewards, next_states, dones, env_stats, self.rows, self.states, \
+            self.completed = self._conn.recv()
+        if stats is None:
+            stats = Statistics()
+        stats.set_all(env_stats)
+        return rewards, next_states, dones, stats
+
+    def reset(self):
+        self._conn.send((RESET, None))
+        self.rows, self.states = self._conn.recv()
+
+    def render(self):
+        self._conn.send((RENDER, None))
+
+    def close(self):
+        self._conn.send((CLOSE, None))
+        self._conn.close()
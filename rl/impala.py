@@ -0,0 +1,306 @@
+import copy
+import threading
+import time
+import numpy as np
+import torch
+import torch.optim as optim
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from gym import spaces
+
+from rl import Statistics
+from rl.ppo import Net
+
+
+class Impala:
+    """ Actor-learner agent with V-trace off-policy correction
+    (https://arxiv.org/abs/1802.01561).
+
+    Actors act with a copy of the network and cut the experience into
+    fixed-length rollouts. The learner consumes them asynchronously in a
+    background thread and publishes new weights to the actors after each
+    update. Actors block only if the learner falls behind by more than
+    `queue_size` rollouts. Errors of the learner are raised to the actors.
+
+    With the worker policy (create_env(worker_policy=True)) the worker
+    processes are the actors: they act with the weights which the Runner
+    publishes after each update and return the log probabilities of the
+    actions along with them. The main process only cuts the rollouts, so
+    acting scales with the workers. Otherwise the actors run in the Runner
+    loop of the main process. The rollouts hold every environment at every
+    step, partial batches aren't supported.
+    """
+
+    def __init__(
+            self,
+            action_space,
+            observation_shape,
+            n_envs,
+            gamma=0.99,
+            unroll_length=20,
+            rho_bar=1.0,
+            c_bar=1.0,
+            baseline_cost=0.5,
+            entropy_cost=0.01,
+            queue_size=2,
+            learning_rate=0.0001):
+
+        print("IMPALA agent:")
+
+        self._observation_shape = observation_shape
+        print("\tState shape: {}".format(self._observation_shape))
+        self._action_space = action_space
+        self._n_envs = n_envs
+        self._gamma = gamma
+        print("\tReward discount (gamma): {}".format(self._gamma))
+        self._unroll_length = unroll_length
+        print("\tUnroll length: {}".format(self._unroll_length))
+        self._rho_bar = rho_bar
+        self._c_bar = c_bar
+        print("\tV-trace truncation. rho: {}, c: {}".format(
+            self._rho_bar, self._c_bar))
+        self._baseline_cost = baseline_cost
+        self._entropy_cost = entropy_cost
+
+        self._device = torch.device(
+                "cuda" if torch.cuda.is_available() else "cpu")
+
+        self._learning_rate = learning_rate
+        print("\tLearning rate: {}".format(learning_rate))
+
+        self._lock = threading.Lock()
+        # Incremented each time the weights of the acting network change
+        self.policy_version = 0
+        self.net = Net(observation_shape, action_space)
+
+        # A future per rollout, its result is the learner statistics
+        self._learner = ThreadPoolExecutor(max_workers=1)
+        self._pending = deque()
+        self._queue_size = queue_size
+        print("\tRollouts queue size: {}".format(queue_size))
+        self._reset_rollout()
+
+    @property
+    def _is_continous(self):
+        return isinstance(self._action_space, spaces.Box)
+
+    def save(self):
+        # The learner may be in the middle of an update, so the
+        # consistent copy of the weights is the actor's one.
+        return {
+            "net": copy.deepcopy(self.acting_net),
+        }
+
+    def load(self, props):
+        self.net = props["net"]
+
+    @property
+    def net(self):
+        return self._net
+
+    @net.setter
+    def net(self, net):
+        self._net = net
+        self._net.to(self._device)
+        self._optimizer = optim.Adam(
+                self._net.parameters(),
+                lr=self._learning_rate)
+        self._publish()
+
+    @property
+    def acting_net(self):
+        """ Network which is used for collecting the experience """
+        with self._lock:
+            return self._actor_net
+
+    def _publish(self):
+        # The actor network is replaced rather than updated in place, so
+        # it can be read without the lock once it has been taken
+        actor_net = copy.deepcopy(self._net)
+        actor_net.train(False)
+        with self._lock:
+            self._actor_net = actor_net
+            self.policy_version += 1
+
+    def step(self, states):
+        states_tensor = torch.from_numpy(states).float().to(self._device)
+        with torch.no_grad():
+            dist = self._distribution(self.acting_net(states_tensor))
+            actions = dist.sample()
+            self._behavior_log_probs = self._log_prob(dist, actions)
+        return actions.cpu().numpy()
+
+    def episodes_end(self):
+        self._send_rollout()
+
+    def transitions(
+            self, states, actions, rewards, next_states, term,
+            env_ids=None, log_probs=None):
+        """ log_probs: of the actions under the policy of the workers which
+        picked them, by default the ones of the last step() """
+        assert not self.eval
+        assert env_ids is None and len(states) == self._n_envs, \
+            "IMPALA rollouts need the transitions of all the environments"
+        if log_probs is None:
+            log_probs = self._behavior_log_probs.cpu().numpy()
+        idx = self._cursor
+        self._states[idx] = states
+        self._actions[idx] = actions
+        self._rewards[idx] = rewards
+        self._dones[idx] = term
+        self._log_probs[idx] = log_probs
+        self._bootstrap_states = next_states
+        self._cursor += 1
+
+        if self._cursor == self._unroll_length:
+            self._send_rollout()
+
+        stats = Statistics()
+        while self._pending and self._pending[0].done():
+            stats.set_all(self._pending.popleft().result())
+        stats.set('replay_buffer_size', len(self._pending))
+        return stats
+
+    def _reset_rollout(self):
+        shape = (self._unroll_length, self._n_envs)
+        self._cursor = 0
+        self._states = np.empty(
+                shape + self._observation_shape, dtype=np.float32)
+        self._actions = np.empty(
+                shape + self._action_space.shape,
+                dtype=self._action_space.dtype)
+        self._rewards = np.empty(shape, dtype=np.float32)
+        self._dones = np.empty(shape, dtype=np.bool_)
+        self._log_probs = np.empty(shape, dtype=np.float32)
+        self._bootstrap_states = None
+
+    def _send_rollout(self):
+        if self._cursor == 0:
+            return
+        length = self._cursor
+        rollout = (
+                self._states[:length],
+                self._actions[:length],
+                self._rewards[:length],
+                self._dones[:length],
+                self._log_probs[:length],
+                np.asarray(self._bootstrap_states, dtype=np.float32))
+        # Wait for the learner to catch up, result() raises its errors
+        if len(self._pending) >= self._queue_size:
+            self._pending[0].result()
+        self._pending.append(self._learner.submit(self._learn, rollout))
+        self._reset_rollout()
+
+    def _distribution(self, net_output):
+        if self._is_continous:
+            mu, sigma, _ = net_output
+            return torch.distributions.Normal(mu, sigma)
+        action_logits, _, _ = net_output
+        return torch.distributions.categorical.Categorical(
+                logits=action_logits)
+
+    def _log_prob(self, dist, actions):
+        log_probs = dist.log_prob(actions)
+        if self._is_continous:
+            # Sub-actions are independent
+            log_probs = log_probs.sum(dim=-1)
+        return log_probs
+
+    def _learn(self, rollout):
+        stats = self._optimize(rollout)
+        self._publish()
+        return stats
+
+    def _optimize(self, rollout):
+        stats = Statistics()
+        t0 = time.time()
+        self.net.train(True)
+
+        states, actions, rewards, dones, behavior_log_probs, \
+            bootstrap_states = rollout
+        unroll_length, n_envs = rewards.shape
+        batch_size = unroll_length * n_envs
+
+        states = torch.from_numpy(states).float().to(self._device)
+        states = states.view((batch_size,) + self._observation_shape)
+        actions = torch.from_numpy(actions).to(self._device)
+        actions = actions.view((batch_size,) + self._action_space.shape)
+        actions = actions.float() if self._is_continous else actions.long()
+        rewards = torch.from_numpy(rewards).to(self._device)
+        discounts = torch.from_numpy(
+                (1. - dones) * self._gamma).float().to(self._device)
+        behavior_log_probs = torch.from_numpy(
+                behavior_log_probs).to(self._device)
+        bootstrap_states = torch.from_numpy(
+                bootstrap_states).float().to(self._device)
+
+        net_output = self.net(states)
+        dist = self._distribution(net_output)
+        log_probs = self._log_prob(dist, actions).view(unroll_length, n_envs)
+        v = net_output[2].view(unroll_length, n_envs)
+        with torch.no_grad():
+            _, _, bootstrap_v = self.net(bootstrap_states)
+            bootstrap_v = bootstrap_v.squeeze(dim=1)
+
+        log_rhos = log_probs.detach() - behavior_log_probs
+        vs, pg_advantages = vtrace(
+                log_rhos=log_rhos,
+                discounts=discounts,
+                rewards=rewards,
+                values=v.detach(),
+                bootstrap_value=bootstrap_v,
+                rho_bar=self._rho_bar,
+                c_bar=self._c_bar)
+
+        # Minus is here because optimizer is going to *minimize* the loss
+        actor_loss = -(pg_advantages * log_probs).mean()
+        critic_loss = ((vs - v) ** 2).mean()
+        entropy = dist.entropy()
+        if self._is_continous:
+            entropy = entropy.sum(dim=-1)
+        entropy = entropy.mean()
+
+        loss = actor_loss + self._baseline_cost * critic_loss - \
+            self._entropy_cost * entropy
+        self._optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(self.net.parameters(), 30.0)
+        self._optimizer.step()
+
+        stats.set('loss', loss.detach())
+        stats.set('loss_actor', actor_loss.detach())
+        stats.set('loss_critic', critic_loss.detach())
+        stats.set('entropy', entropy.detach())
+        stats.set('importance_ratio', log_rhos.exp().mean())
+        stats.set('optimization_time', time.time() - t0)
+        stats.set('ppo_optimization_samples', batch_size)
+        return stats
+
+
+def vtrace(
+        log_rhos, discounts, rewards, values, bootstrap_value,
+        rho_bar=1.0, c_bar=1.0):
+    """ V-trace targets and policy gradient advantages.
+
+    All arguments except bootstrap_value have shape (T, N),
+    bootstrap_value has shape (N,).
+    """
+    rhos = log_rhos.exp()
+    clipped_rhos = rhos.clamp(max=rho_bar)
+    cs = rhos.clamp(max=c_bar)
+
+    bootstrap_value = bootstrap_value.unsqueeze(0)
+    values_next = torch.cat([values[1:], bootstrap_value], dim=0)
+    deltas = clipped_rhos * (rewards + discounts * values_next - values)
+
+    vs_minus_v = []
+    acc = torch.zeros_like(bootstrap_value[0])
+    for t in reversed(range(len(deltas))):
+        acc = deltas[t] + discounts[t] * cs[t] * acc
+        vs_minus_v.append(acc)
+    vs_minus_v = torch.stack(vs_minus_v[::-1], dim=0)
+    vs = vs_minus_v + values
+
+    vs_next = torch.cat([vs[1:], bootstrap_value], dim=0)
+    pg_advantages = clipped_rhos * (rewards + discounts * vs_next - values)
+    return vs, pg_advantages
@@ -0,0 +1,113 @@
+import time
+import numpy as np
+
+
+# Shortest and longest episodes of the builds, steps
+episode_lengths = {
+    "banana": (300, 300),
+    "reachersingle": (1001, 1001),
+    "reacher": (1001, 1001),
+    "crawler": (50, 1000),
+    "tennis": (14, 1000),
+}
+
+
+class MockBrain:
+    """ BrainParameters of a Unity environment, built from UnityEnvConfig """
+
+    def __init__(self, config):
+        self.brain_name = "{}Brain".format(config.id)
+        self.vector_observation_space_type = "continuous"
+        self.vector_observation_space_size = config.observation_size
+        self.vector_action_space_type = config.action_type
+        self.vector_action_space_size = config.action_size
+
+
+class MockBrainInfo:
+
+    def __init__(self, vector_observations, rewards, local_done):
+        self.vector_observations = vector_observations
+        self.rewards = rewards
+        self.local_done = local_done
+
+
+class MockUnityEnvironment:
+    """ Stand-in for unityagents.UnityEnvironment with the brain of a build
+    from unity_env_list, random observations and rewards.
+
+    Like a Unity build, it runs at real-time speed, one step per
+    frame_time seconds, unless it is reset with train_mode=True which
+    speeds the time up by the training time scale. On top of that every
+    step takes latency ± jitter seconds to simulate.
+
+    Every sub-environment ends its episodes independently, after a number
+    of steps drawn from episode_lengths of the build. All its agents are
+    done at once.
+    """
+
+    training_time_scale = 100.
+
+    def __init__(
+            self, config, worker_id=0, frame_time=0.02, latency=0.,
+            jitter=0.):
+        brain = MockBrain(config)
+        self.brain_names = [brain.brain_name]
+        self.brains = {brain.brain_name: brain}
+        self._n_envs = config.n_envs
+        self._n_agents = config.n_agents
+        self._observation_size = config.observation_size
+        self._episode_lengths = episode_lengths[config.id]
+        self._frame_time = frame_time
+        self._latency = latency
+        self._jitter = jitter
+        self._time_scale = 1.
+        self._next_frame = time.time()
+        self._rng = np.random.RandomState(worker_id)
+        self._steps = np.zeros(self._n_envs, dtype=np.int64)
+        self._lengths = np.zeros(self._n_envs, dtype=np.int64)
+
+    def reset(self, train_mode=True):
+        self._time_scale = self.training_time_scale if train_mode else 1.
+        self._next_frame = time.time()
+        self._steps[:] = 0
+        self._lengths[:] = self._episode_length(self._n_envs)
+        return self._brain_info(np.zeros(self._n_envs, dtype=np.bool_))
+
+    def step(self, vector_action):
+        assert len(vector_action) == self._n_envs * self._n_agents
+        self._simulate()
+        self._steps += 1
+        dones = self._steps >= self._lengths
+        brain_info = self._brain_info(dones)
+
+        # Unity restarts the finished episodes by itself
+        self._steps[dones] = 0
+        self._lengths[dones] = self._episode_length(np.count_nonzero(dones))
+        return brain_info
+
+    def close(self):
+        return
+
+    def _simulate(self):
+        delay = self._latency
+        if self._jitter > 0:
+            delay += self._rng.uniform(-self._jitter, self._jitter)
+        # The frame ends no sooner than its scaled duration has passed
+        self._next_frame += self._frame_time / self._time_scale
+        delay = max(delay, self._next_frame - time.time())
+        if delay > 0:
+            time.sleep(delay)
+        self._next_frame = max(self._next_frame, time.time())
+
+    def _episode_length(self, count):
+        low, high = self._episode_lengths
+        return self._rng.randint(low, high + 1, size=count)
+
+    def _brain_info(self, dones):
+        rows = self._n_envs * self._n_agents
+        brain_info = MockBrainInfo(
+                self._rng.randn(
+                    rows, self._observation_size).astype(np.float32),
+                self._rng.uniform(-0.1, 0.1, rows).tolist(),
+                np.repeat(dones, self._n_agents).tolist())
+        return {self.brain_names[0]: brain_info}
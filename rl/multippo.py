@@ -1,5 +1,8 @@
 import numpy as np
 import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from concurrent.futures import ThreadPoolExecutor
 from rl import PPO
 from rl import Statistics
 
@@ -18,12 +21,18 @@ class MultiPPO:
             gae_lambda=0.95,
             epochs=12,
             epsilon=0.2,
-            learning_rate=0.0001):
+            learning_rate=0.0001,
+            pipeline=False,
+            stacked=False,
+            parallel=False,
+            shared_policy=False,
+            agent_id=False):
 
         print("MultiPPO agent:")
         print("\tNumber of sub-agents: {}".format(n_agents))
         self._n_envs = n_envs
         print("\tNumber of environments: {}".format(self._n_envs))
+        self._n_agents = n_agents
 
         # State preprocessor
         state_processor = unite_states if combine_states else noop_states
@@ -32,26 +41,65 @@ class MultiPPO:
             n_envs,
             observation_shape,
         )
+        if agent_id:
+            print("\tOne-hot agent id is added to the states")
+            self._state_preprocessor, observation_shape = add_agent_id(
+                self._state_preprocessor,
+                n_agents,
+                n_envs,
+                observation_shape,
+            )
 
-        # Create agents
+        # Create agents. In the shared policy mode a single PPO agent acts
+        # for every agent and is trained on the transitions of all of them.
+        self._shared_policy = shared_policy
+        if self._shared_policy:
+            print("\tSingle policy is shared between all agents")
+            assert not stacked and not parallel
+        n_policies = 1 if self._shared_policy else n_agents
+        policy_envs = n_envs * n_agents if self._shared_policy else n_envs
         assert len(observation_shape) == 1
         self._agents = [
             PPO(
                 action_space,
                 observation_shape,
-                n_envs=n_envs,
+                n_envs=policy_envs,
                 gamma=gamma,
                 horizon=horizon,
                 gae_lambda=gae_lambda,
                 epochs=epochs,
                 epsilon=epsilon,
                 learning_rate=learning_rate,
+                pipeline=pipeline,
+                name="agent-{}".format(idx),
             )
-            for _ in range(n_agents)
+            for idx in range(n_policies)
         ]
         self._action_space = action_space
         self._observation_shape = observation_shape
 
+        # Stacked weights of the sub-agents for the batched forward pass
+        self._stacked = stacked
+        self._stacked_nets = None
+        self._stacked_versions = None
+        if self._stacked:
+            print("\tSub-agents are evaluated in a single batched forward")
+
+        # Sub-agents are optimized concurrently. PyTorch releases the GIL
+        # inside its kernels, so threads are enough to occupy several cores.
+        # Each thread gets its share of the intra-op threads, otherwise
+        # they oversubscribe the cores.
+        self._executor = None
+        if parallel:
+            cores = torch.get_num_threads()
+            self._intra_op_threads = max(1, cores // n_agents)
+            workers = min(
+                    n_agents, max(1, cores // self._intra_op_threads))
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            print("\tSub-agents are optimized in parallel: " +
+                  "{} threads, {} intra-op threads each".format(
+                      workers, self._intra_op_threads))
+
     def save(self):
         return {
             "agent-{}".format(idx): agent.save()
@@ -64,41 +112,116 @@ class MultiPPO:
 
     def step(self, states):
         batch_size = len(states)
+        actions_shape = (batch_size,) + self._action_space.shape
 
+        # States of each agent are contiguous: (n_agents, n_envs, ...)
         states = self._state_preprocessor(states)
-        actions_shape = (batch_size,) + self._action_space.shape
-        actions = np.empty(shape=actions_shape, dtype=self._action_space.dtype)
-        for agent_idx, agent in enumerate(self._agents):
-            agent_states = states[agent_idx::self._n_agents]
-            agent_actions = agent.step(agent_states)
-            actions[agent_idx::self._n_agents, :] = agent_actions
+        if self._shared_policy:
+            actions = self._agents[0].step(
+                    states.reshape((batch_size,) + self._observation_shape))
+            actions = actions.reshape(
+                    (self._n_agents, -1) + self._action_space.shape)
+        elif self._stacked:
+            actions = self._step_stacked(states)
+        else:
+            actions = np.stack([
+                agent.step(states[agent_idx])
+                for agent_idx, agent in enumerate(self._agents)
+            ])
 
+        # Scatter the actions back in the environment order
+        actions = env_major(actions)
         assert actions.shape == actions_shape, actions.shape
         return actions
 
+    def _step_stacked(self, states):
+        versions = tuple(agent.policy_version for agent in self._agents)
+        if versions != self._stacked_versions:
+            self._stacked_nets = StackedActors(
+                    [agent.acting_net for agent in self._agents])
+            self._stacked_versions = versions
+
+        states = np.ascontiguousarray(states)
+        states_tensor = torch.from_numpy(states).float().to(
+                self._stacked_nets.device)
+        with torch.no_grad():
+            actions = self._stacked_nets.sample(states_tensor)
+        return actions.cpu().numpy()
+
     def episodes_end(self):
         for agent in self._agents:
             agent.episodes_end()
 
-    def transitions(self, states, actions, rewards, next_states, term):
-        states = self._state_preprocessor(states)
-        next_states = self._state_preprocessor(next_states)
-        batch_size = self._n_agents * self._n_envs
+    def transitions(
+            self, states, actions, rewards, next_states, term, env_ids=None):
+        """ env_ids: rows of a partial batch, see MultiEnv.rows """
+        n_agents = self._n_agents
+        batch_size = len(states)
+        assert batch_size % n_agents == 0, batch_size
         actions_shape = (batch_size,) + self._action_space.shape
         assert actions.shape == actions_shape, actions.shape
+
+        # Trajectories of the sub-agents are indexed by environment
+        envs = None
+        if env_ids is not None:
+            envs = np.asarray(env_ids)[::n_agents] // n_agents
+        states = self._state_preprocessor(states)
+        next_states = self._state_preprocessor(next_states)
+        actions = agent_major(actions, n_agents)
+        rewards = agent_major(rewards, n_agents)
+        term = agent_major(term, n_agents)
+
+        if self._shared_policy:
+            states_shape = (batch_size,) + self._observation_shape
+            if envs is not None:
+                envs = (np.arange(n_agents)[:, np.newaxis] * self._n_envs +
+                        envs).reshape(-1)
+            return self._agents[0].transitions(
+                    states.reshape(states_shape),
+                    actions.reshape(actions_shape),
+                    rewards.reshape(batch_size),
+                    next_states.reshape(states_shape),
+                    term.reshape(batch_size),
+                    env_ids=envs)
+
         stats = Statistics()
-        n_agents = self._n_agents
-        for idx, agent in enumerate(self._agents):
-            s = agent.transitions(
-                    states[idx::n_agents],
-                    actions[idx::n_agents],
-                    rewards[idx::n_agents],
-                    next_states[idx::n_agents],
-                    term[idx::n_agents],
+        agents_args = [
+            (
+                states[idx],
+                actions[idx],
+                rewards[idx],
+                next_states[idx],
+                term[idx],
+                envs,
             )
+            for idx in range(n_agents)
+        ]
+        if self._executor is None:
+            agents_stats = [
+                agent.transitions(*args)
+                for agent, args in zip(self._agents, agents_args)
+            ]
+        else:
+            agents_stats = self._parallel_transitions(agents_args)
+        for s in agents_stats:
             stats.set_all(s)
         return stats
 
+    def _parallel_transitions(self, agents_args):
+        # The number of the intra-op threads is global to the process, so
+        # it is lowered only while the sub-agents are optimized together.
+        # The acting and the GAE keep all the cores.
+        threads = torch.get_num_threads()
+        torch.set_num_threads(self._intra_op_threads)
+        try:
+            futures = [
+                self._executor.submit(agent.transitions, *args)
+                for agent, args in zip(self._agents, agents_args)
+            ]
+            return [future.result() for future in futures]
+        finally:
+            torch.set_num_threads(threads)
+
     @property
     def eval(self):
         return self._eval
@@ -109,19 +232,105 @@ class MultiPPO:
         for agent in self._agents:
             agent.eval = v
 
-    @property
-    def _n_agents(self):
-        return len(self._agents)
+
+class StackedActors:
+    """ Actor parts of several PPO networks with stacked weights.
+    All networks are evaluated with batched matrix multiplications. """
+
+    def __init__(self, nets):
+        net = nets[0]
+        self.is_continous = net._is_continous
+        self.device = next(net.parameters()).device
+        self._layers = []
+        for idx, module in enumerate(net.middleware_actor):
+            if isinstance(module, nn.Linear):
+                self._layers.append(_stack_linear(
+                    [n.middleware_actor[idx] for n in nets]))
+            else:
+                assert isinstance(module, nn.ReLU), module
+                self._layers.append(None)
+        if self.is_continous:
+            self._head = _stack_linear([n.head_mu for n in nets])
+            self._mu_scale = torch.stack(
+                    [n.mu_scale for n in nets]).unsqueeze(1)
+            self._mu_offset = torch.stack(
+                    [n.mu_offset for n in nets]).unsqueeze(1)
+            self._variance = F.softplus(torch.stack(
+                [n.head_variance for n in nets]).unsqueeze(1).detach())
+        else:
+            self._head = _stack_linear([n.head_action_logits for n in nets])
+
+    def forward(self, states):
+        """ states: (n_nets, batch_size, observation_size)
+        Returns the action means of the continuous spaces and the action
+        logits of the discrete ones. """
+        x = states
+        for layer in self._layers:
+            x = F.relu(x) if layer is None else _linear(x, *layer)
+        x = _linear(x, *self._head)
+        if self.is_continous:
+            return torch.tanh(x) * self._mu_scale + self._mu_offset
+        return x
+
+    def sample(self, states):
+        """ states: (n_nets, batch_size, observation_size) """
+        x = self.forward(states)
+        if self.is_continous:
+            dist = torch.distributions.Normal(x, self._variance.expand_as(x))
+        else:
+            dist = torch.distributions.categorical.Categorical(logits=x)
+        return dist.sample()
+
+
+def _stack_linear(layers):
+    weight = torch.stack([l.weight.detach().t() for l in layers])
+    bias = None
+    if layers[0].bias is not None:
+        bias = torch.stack([l.bias.detach() for l in layers]).unsqueeze(1)
+    return weight, bias
+
+
+def _linear(x, weight, bias):
+    if bias is None:
+        return torch.bmm(x, weight)
+    return torch.baddbmm(bias, x, weight)
+
+
+def agent_major(x, n_agents):
+    """ (n_envs * n_agents, ...) → (n_agents, n_envs, ...).
+    The data of each agent becomes contiguous. """
+    x = x.reshape((-1, n_agents) + x.shape[1:])
+    return np.ascontiguousarray(x.swapaxes(0, 1))
+
+
+def env_major(x):
+    """ (n_agents, n_envs, ...) → (n_envs * n_agents, ...) """
+    return x.swapaxes(0, 1).reshape((-1,) + x.shape[2:])
 
 
 def noop_states(n_agents, n_envs, observation_shape):
 
     def _noop(states):
-        return states
+        return agent_major(states, n_agents)
 
     return _noop, observation_shape
 
 
+def add_agent_id(state_processor, n_agents, n_envs, observation_shape):
+
+    assert len(observation_shape) == 1
+    agent_ids = np.eye(n_agents, dtype=np.float32)[:, np.newaxis, :]
+    agent_ids = np.repeat(agent_ids, n_envs, axis=1)
+
+    def _preprocess(states):
+        states = state_processor(states)
+        # Partial batches contain only a part of the environments
+        return np.concatenate(
+                [states, agent_ids[:, :states.shape[1]]], axis=2)
+
+    return _preprocess, (observation_shape[0] + n_agents,)
+
+
 def unite_states(n_agents, n_envs, observation_shape):
 
     assert len(observation_shape) == 1
@@ -129,24 +338,19 @@ def unite_states(n_agents, n_envs, observation_shape):
 
     def _preprocess(states):
         batch_size = len(states)
-        assert batch_size == n_agents * n_envs, batch_size
-
-        env_batch_size = int(batch_size / n_envs)
-
-        united_states = []
-        for env_idx in range(n_envs):
-            idx_start = env_idx * env_batch_size
-            idx_end = idx_start + env_batch_size
-            # Combine the states of the agents into the single united state
-            env_state = states[idx_start:idx_end, :]
-            env_state = env_state.reshape((1, -1))
-            united_shape = (1, state_size)
-            assert env_state.shape == united_shape, env_state.shape
-            united_states.append(env_state)
-            united_states.append(env_state)
-
-        united_states = np.concatenate(united_states, axis=0)
-        assert united_states.shape == (batch_size, state_size)
+        assert batch_size % n_agents == 0, batch_size
+        assert batch_size <= n_agents * n_envs, batch_size
+        batch_envs = batch_size // n_agents
+
+        # Combine the states of the agents into the single united state.
+        # Every agent gets the same united state, so instead of copying it
+        # n_agents times all of them share the same memory.
+        united_states = np.ascontiguousarray(states).reshape(
+                (batch_envs, state_size))
+        united_states = np.lib.stride_tricks.as_strided(
+                united_states,
+                shape=(n_agents, batch_envs, state_size),
+                strides=(0,) + united_states.strides)
         return united_states
 
     return _preprocess, (state_size,)
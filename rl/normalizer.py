@@ -0,0 +1,111 @@
+import numpy as np
+
+
+class ObservationNormalizer:
+    """ Normalizes a whole batch of observations at once.
+
+    With low and high bounds the observations are linearly rescaled from
+    [low, high] to [-1, 1]. Without them they are standardized with the
+    running mean and variance, which are updated with every batch while
+    `training` is set, and clipped to [-clip, clip].
+    """
+
+    def __init__(self, shape, low=None, high=None, clip=5.0, epsilon=1e-8):
+        self.training = True
+        self._bounds = None
+        self._clip = clip
+        self._epsilon = epsilon
+        if low is not None:
+            self._bounds = (
+                    np.asarray(low, dtype=np.float64),
+                    np.asarray(high, dtype=np.float64))
+        else:
+            self._count = 0
+            self._mean = np.zeros(shape, dtype=np.float64)
+            self._var = np.ones(shape, dtype=np.float64)
+        self._update_coefficients()
+
+    def __call__(self, states, update=False):
+        """ Normalized copy of the states. With update=True the states also
+        contribute to the running statistics, if they are collected. """
+        if update and self.training and self._bounds is None:
+            self._update(states)
+        out = np.multiply(states, self._scale, dtype=np.float32)
+        out += self._offset
+        if self._bounds is None:
+            np.clip(out, -self._clip, self._clip, out=out)
+        return out
+
+    def _update(self, states):
+        """ Merges the moments of the batch into the running ones
+        (Chan et al. parallel variant of Welford's algorithm) """
+        states = np.reshape(states, (-1,) + self._mean.shape)
+        batch_count = len(states)
+        if batch_count == 0:
+            return
+        batch_mean = states.mean(axis=0, dtype=np.float64)
+        batch_var = states.var(axis=0, dtype=np.float64)
+
+        count = self._count + batch_count
+        delta = batch_mean - self._mean
+        m2 = self._var * self._count + batch_var * batch_count + \
+            delta ** 2 * self._count * batch_count / count
+        self._mean = self._mean + delta * batch_count / count
+        self._var = m2 / count
+        self._count = count
+        self._update_coefficients()
+
+    def _update_coefficients(self):
+        # Normalization is a single x * scale + offset
+        if self._bounds is not None:
+            low, high = self._bounds
+            scale = 2.0 / (high - low)
+            offset = -low * scale - 1.0
+        else:
+            scale = 1.0 / np.sqrt(self._var + self._epsilon)
+            offset = -self._mean * scale
+        self._scale = scale.astype(np.float32)
+        self._offset = offset.astype(np.float32)
+
+    def state_dict(self):
+        if self._bounds is not None:
+            low, high = self._bounds
+            return {"low": low, "high": high}
+        return {
+            "count": self._count,
+            "mean": self._mean,
+            "var": self._var,
+            "clip": self._clip,
+        }
+
+    @staticmethod
+    def from_state_dict(state):
+        if "low" in state:
+            return ObservationNormalizer(
+                    np.shape(state["low"]), low=state["low"],
+                    high=state["high"])
+        normalizer = ObservationNormalizer(
+                np.shape(state["mean"]), clip=state["clip"])
+        normalizer.load_state_dict(state)
+        return normalizer
+
+    def load_state_dict(self, state):
+        saved = _kind("low" in state)
+        current = _kind(self._bounds is not None)
+        assert saved == current, \
+            "Observations were normalized with {} when saved and with {} " \
+            "now, check --normalize_obs".format(saved, current)
+        if self._bounds is not None:
+            self._bounds = (
+                    np.asarray(state["low"], dtype=np.float64),
+                    np.asarray(state["high"], dtype=np.float64))
+        else:
+            self._count = state["count"]
+            self._mean = np.asarray(state["mean"], dtype=np.float64)
+            self._var = np.asarray(state["var"], dtype=np.float64)
+            self._clip = state["clip"]
+        self._update_coefficients()
+
+
+def _kind(bounds):
+    return "fixed bounds" if bounds else "running statistics"
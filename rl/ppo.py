@@ -1,3 +1,4 @@
+import copy
 import time
 import numpy as np
 import torch
@@ -5,9 +6,15 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from multiprocessing import Value
+from multiprocessing.sharedctypes import RawArray
 from torch.multiprocessing import Process, Queue, cpu_count
+from torch.nn.utils import parameters_to_vector, vector_to_parameters
 
 from rl import Statistics, TrajectoryBuffer, Trajectory
+from rl.diagnostics import diagnostics
+from rl.profiler import profiler
 from gym import spaces
 
 
@@ -23,9 +30,12 @@ class PPO:
             gae_lambda=0.95,
             epochs=12,
             epsilon=0.2,
-            learning_rate=0.0001):
+            learning_rate=0.0001,
+            pipeline=False,
+            name="ppo"):
 
         print("PPO agent:")
+        self._name = name  # prefix of the diagnostics sites
 
         self._observation_shape = observation_shape
         print("\tState shape: {}".format(self._observation_shape))
@@ -42,6 +52,18 @@ class PPO:
         self._learning_rate = learning_rate
         print("\tLearning rate: {}".format(learning_rate))
 
+        # Pipelined mode: rollout k+1 is collected by a snapshot of the
+        # policy while the learner thread optimizes on the rollout k.
+        self._pipeline = pipeline
+        self._learner = None
+        self._pending = None
+        if self._pipeline:
+            self._learner = ThreadPoolExecutor(max_workers=1)
+            print("\tPipelined optimization is enabled")
+
+        # Incremented each time the weights of the acting network change
+        self.policy_version = 0
+
         self.net = Net(observation_shape, action_space)
 
         self._horizon = horizon
@@ -65,6 +87,9 @@ class PPO:
         return _is_continous(self._action_space)
 
     def save(self):
+        if self._pending is not None:
+            # Don't save the network in the middle of the optimization
+            wait([self._pending])
         return {
             "net": self.net,
         }
@@ -83,10 +108,26 @@ class PPO:
         self._optimizer = optim.Adam(
                 self._net.parameters(),
                 lr=self._learning_rate)
+        self._snapshot = None
+        if self._pipeline:
+            self._take_snapshot()
+        self.policy_version += 1
+
+    @property
+    def acting_net(self):
+        """ Network which is used for collecting the experience """
+        if self._snapshot is not None:
+            return self._snapshot
+        return self.net
+
+    def _take_snapshot(self):
+        self._snapshot = copy.deepcopy(self.net)
+        self._snapshot.train(False)
 
     def step(self, states):
         states_tensor = torch.from_numpy(states).float().to(self._device)
-        self.net.train(False)
+        net = self.acting_net
+        net.train(False)
         batch_size = len(states)
         states_shape = (batch_size,) + self._observation_shape
         assert states_tensor.shape == states_shape, states_tensor.shape
@@ -94,7 +135,7 @@ class PPO:
         if self._is_continous:
             action_shape = (batch_size, ) + self._action_space.shape
             with torch.no_grad():
-                actions_mu, actions_var, _ = self.net(states_tensor)
+                actions_mu, actions_var, _ = net(states_tensor)
                 assert actions_mu.shape == action_shape, actions_mu
                 assert actions_var.shape == action_shape, actions_var
                 actions_arr = []
@@ -113,7 +154,7 @@ class PPO:
                 assert actions.shape == action_shape, actions.shape
         else:
             with torch.no_grad():
-                action_logits, _, _ = self.net(states_tensor)
+                action_logits, _, _ = net(states_tensor)
                 dist = torch.distributions.categorical.Categorical(
                         logits=action_logits)
                 actions = dist.sample()
@@ -125,14 +166,20 @@ class PPO:
     def episodes_end(self):
         self._buffer.close_trajectories()
 
-    def transitions(self, states, actions, rewards, next_states, term):
+    def transitions(
+            self, states, actions, rewards, next_states, term, env_ids=None,
+            log_probs=None):
+        """ log_probs of the actions picked by the worker policy aren't
+        used, the optimization evaluates the acting network instead """
         assert not self.eval
-        self._buffer.push(
-                states,
-                actions,
-                rewards,
-                next_states,
-                term)
+        with profiler.span("buffer_push"):
+            self._buffer.push(
+                    states,
+                    actions,
+                    rewards,
+                    next_states,
+                    term,
+                    env_ids=env_ids)
         return self._optimize()
 
     def _v(self, states):
@@ -140,7 +187,7 @@ class PPO:
         states_tensor = torch.tensor(states).float().to(self._device)
         assert states_tensor.shape == (len(states),) + self._observation_shape
         with torch.no_grad():
-            _, _, v = self.net(states_tensor)
+            _, _, v = self.acting_net(states_tensor)
             v = v.cpu().numpy()
         assert v.shape == (len(states), 1)
         v = np.squeeze(v, axis=1)
@@ -149,17 +196,83 @@ class PPO:
 
     def _optimize(self):
         stats = Statistics()
-        t0 = time.time()
         stats.set('replay_buffer_size', len(self._buffer))
         if not self._buffer.ready():
             return stats
 
+        with profiler.span("optimize/sample"):
+            batch = self._buffer.sample()
+            self._buffer.reset()
+
+        if not self._pipeline:
+            with profiler.span("optimize"):
+                stats.set_all(self._optimize_batch(batch))
+            self.policy_version += 1
+            return stats
+
+        # Policy lag is bounded by one rollout: before handing over the
+        # next batch, wait until the learner is done with the previous one.
+        if self._pending is not None:
+            stats.set_all(self._pending.result())
+        behavior_net = self.acting_net
+        self._take_snapshot()
+        self.policy_version += 1
+        self._pending = self._learner.submit(
+                self._profiled_optimize_batch, batch, behavior_net)
+        return stats
+
+    def _profiled_optimize_batch(self, batch, behavior_net):
+        with profiler.span("optimize"):
+            return self._optimize_batch(batch, behavior_net)
+
+    def _log_probs(self, net, states, actions):
+        batch_size = len(states)
+        if self._is_continous:
+            actions_shape = (batch_size, ) + self._action_space.shape
+            actions_mu, actions_var, v = net(states)
+            assert actions_var.shape == actions_shape, actions_var.shape
+            assert actions_mu.shape == actions_shape, actions_mu.shape
+            assert len(self._action_space.shape) == 1
+            log_probs_arr = []
+            for action_idx in range(self._action_space.shape[0]):
+                action_mu = actions_mu[:, action_idx]
+                action_var = actions_var[:, action_idx]
+                assert action_mu.shape == (batch_size,), action_mu.shape
+                assert action_var.shape == (batch_size,), action_var.shape
+                dist = torch.distributions.Normal(action_mu, action_var)
+                sub_actions = actions[:, action_idx]
+                assert sub_actions.shape == (batch_size,)
+                log_probs = dist.log_prob(sub_actions)
+                log_probs_arr.append(log_probs)
+            log_probs = torch.stack(log_probs_arr, dim=1)
+        else:
+            actions_shape = (batch_size, )
+            action_logits, _, v = net(states)
+            assert action_logits.shape == (
+                    batch_size, self._action_space.n)
+            dist = torch.distributions.categorical.Categorical(
+                    logits=action_logits)
+            log_probs = dist.log_prob(actions)
+        assert log_probs.shape == actions_shape, log_probs.shape
+        return log_probs, dist, v
+
+    def _optimize_batch(self, batch, behavior_net=None):
+        """ Runs PPO epochs on the sampled batch.
+
+        behavior_net is the network which collected the batch. When it
+        differs from the optimized network (pipelined mode), its action
+        probabilities are used as the denominator of the importance ratio.
+        """
+        stats = Statistics()
+        t0 = time.time()
+
         self.net.train(True)
 
         # Create tensors: state, action, next_state, term
-        states, actions, target_v, advantage = self._buffer.sample()
+        states, actions, target_v, advantage = batch
         batch_size = len(states)
-        assert batch_size == self._buffer.capacity()
+        # Partial batches of environments may overfill the buffer
+        assert batch_size >= self._buffer.capacity()
 
         states = torch.from_numpy(states).float().to(self._device)
         actions = torch.from_numpy(actions).to(self._device)
@@ -187,38 +300,20 @@ class PPO:
         # Iteratively optimize the network
         critic_loss_fn = nn.MSELoss()
 
-        # Action probabilities of the network before optimization
+        # Action probabilities of the network which collected the batch
         old_log_probs = None
         old_dist = None
+        if behavior_net is not None:
+            with torch.no_grad():
+                old_log_probs, old_dist, _ = self._log_probs(
+                        behavior_net, states, actions)
 
         for _ in range(self._epochs):
 
+            forward_start = time.time()
+
             # Calculate Actor Loss
-            if self._is_continous:
-                actions_mu, actions_var, v = self.net(states)
-                assert actions_var.shape == actions_shape, actions_var.shape
-                assert actions_mu.shape == actions_shape, actions_mu.shape
-                assert len(self._action_space.shape) == 1
-                log_probs_arr = []
-                for action_idx in range(self._action_space.shape[0]):
-                    action_mu = actions_mu[:, action_idx]
-                    action_var = actions_var[:, action_idx]
-                    assert action_mu.shape == (batch_size,), action_mu.shape
-                    assert action_var.shape == (batch_size,), action_var.shape
-                    dist = torch.distributions.Normal(action_mu, action_var)
-                    sub_actions = actions[:, action_idx]
-                    assert sub_actions.shape == (batch_size,)
-                    log_probs = dist.log_prob(sub_actions)
-                    log_probs_arr.append(log_probs)
-                log_probs = torch.stack(log_probs_arr, dim=1)
-            else:
-                action_logits, _, v = self.net(states)
-                assert action_logits.shape == (
-                        batch_size, self._action_space.n)
-                dist = torch.distributions.categorical.Categorical(
-                        logits=action_logits)
-                log_probs = dist.log_prob(actions)
-            assert log_probs.shape == actions_shape, log_probs.shape
+            log_probs, dist, v = self._log_probs(self.net, states, actions)
 
             if old_log_probs is None:
                 old_log_probs = log_probs.detach()
@@ -247,22 +342,28 @@ class PPO:
 
             # Optimize
             loss = critic_loss + actor_loss
+            backward_start = time.time()
+            profiler.event(
+                    "optimize/forward", forward_start,
+                    backward_start - forward_start)
             self._optimizer.zero_grad()
             loss.backward()
             torch.nn.utils.clip_grad_norm_(self.net.parameters(), 30.0)
             self._optimizer.step()
+            profiler.event(
+                    "optimize/backward", backward_start,
+                    time.time() - backward_start)
 
             stats.set('loss_actor', actor_loss.detach())
             stats.set('loss_critic', critic_loss.detach())
             # Log gradients
-            for p in self.net.parameters():
-                if p.grad is not None:
-                    stats.set('grad_max', p.grad.abs().max().detach())
-                    stats.set(
-                            'grad_mean',
-                            (p.grad ** 2).mean().sqrt().detach())
-
-        self._buffer.reset()
+            if diagnostics.due(self._name + "/gradients"):
+                for p in self.net.parameters():
+                    if p.grad is not None:
+                        stats.set('grad_max', p.grad.abs().max().detach())
+                        stats.set(
+                                'grad_mean',
+                                (p.grad ** 2).mean().sqrt().detach())
 
         # Log stats
         stats.set('optimization_time', time.time() - t0)
@@ -270,7 +371,8 @@ class PPO:
         stats.set('ppo_optimization_samples', batch_size)
 
         # Log entropy metric (opposite to confidence)
-        if self._is_continous:
+        if self._is_continous and \
+                diagnostics.due(self._name + "/actions"):
             action_mu, action_var, _ = self.net(states)
             stats.set('action_variance', action_var.mean().detach())
             stats.set(
@@ -365,6 +467,78 @@ class Net(nn.Module):
             return action_logits, None, v
 
 
+def sample_actions(net, states):
+    """ Actions sampled from the policy of the network and their log
+    probabilities """
+    if net._is_continous:
+        actions_mu, actions_var, _ = net(states)
+        dist = torch.distributions.Normal(actions_mu, actions_var)
+        actions = dist.sample()
+        # Sub-actions are independent
+        return actions, dist.log_prob(actions).sum(dim=-1)
+    action_logits, _, _ = net(states)
+    dist = torch.distributions.categorical.Categorical(logits=action_logits)
+    actions = dist.sample()
+    return actions, dist.log_prob(actions)
+
+
+class SharedWeights:
+    """ Parameters of the network in the shared memory with a version
+    counter. Created in the main process and passed to the worker
+    processes on their start. """
+
+    def __init__(self, net):
+        size = sum([p.numel() for p in net.parameters()])
+        self._buffer = RawArray('f', size)
+        self.version = Value('l', 0)
+        self.write(net)
+
+    def write(self, net):
+        weights = parameters_to_vector(net.parameters()).detach().cpu()
+        with self.version.get_lock():
+            np.frombuffer(self._buffer, dtype=np.float32)[:] = \
+                weights.numpy()
+            self.version.value += 1
+
+    def read(self, net, version):
+        """ Copies the weights into the net if they are newer than
+        version. Returns the version of the net's weights. """
+        if self.version.value == version:
+            return version
+        with self.version.get_lock():
+            weights = np.frombuffer(self._buffer, dtype=np.float32).copy()
+            version = self.version.value
+        vector_to_parameters(torch.from_numpy(weights), net.parameters())
+        return version
+
+
+class WorkerPolicy:
+    """ Read-only copy of the PPO or IMPALA network which acts in a worker
+    process. Picks up new weights from SharedWeights before acting. """
+
+    def __init__(
+            self, weights, observation_shape, action_space, normalizer=None):
+        # Workers share the cores, each of them acts on a small batch
+        torch.set_num_threads(1)
+        self._net = Net(observation_shape, action_space)
+        self._net.train(False)
+        self._weights = weights
+        self._version = 0
+        # The same fixed normalization as in the main process
+        self._normalizer = normalizer
+
+    def act(self, states):
+        """ Returns the actions and their log probabilities under the
+        policy which picked them """
+        self._version = self._weights.read(self._net, self._version)
+        if self._normalizer is not None:
+            states = self._normalizer(states)
+        with torch.no_grad():
+            actions, log_probs = sample_actions(
+                    self._net, torch.from_numpy(states).float())
+        return actions.numpy(), log_probs.numpy()
+
+
 class GAETrajectory(Trajectory):
 
     def __init__(
@@ -433,6 +607,7 @@ class GAETrajectoryBuffer(TrajectoryBuffer):
                     args=(
                         gamma, horizon, gae_lambda,
                         self._enrich_queue, self._traj_queue))
+            p.daemon = True
             p.start()
         for _ in range(enricher_count):
             self._traj_queue.get()
@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Profiler:
+    """ Records the phases of the training loop as Chrome trace events,
+    which can be opened in chrome://tracing or https://ui.perfetto.dev.
+
+    Every thread gets its own track, events of the worker processes are
+    put on the tracks named by the caller. Nothing is recorded until
+    `enabled` is set.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._events = []
+        self._tracks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.event(name, t0, time.time() - t0)
+
+    def event(self, name, start, duration, track=None):
+        """ start: seconds since the epoch, duration: seconds """
+        if not self.enabled:
+            return
+        if track is None:
+            track = threading.current_thread().name
+        self._events.append({
+            "name": name,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": duration * 1e6,
+            "pid": os.getpid(),
+            "tid": self._track_id(track),
+        })
+
+    def _track_id(self, track):
+        with self._lock:
+            if track not in self._tracks:
+                self._tracks[track] = len(self._tracks)
+                self._events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": self._tracks[track],
+                    "args": {"name": track},
+                })
+            return self._tracks[track]
+
+    def export(self, filename):
+        """ Writes the events recorded so far and forgets them """
+        with self._lock:
+            events = self._events
+            self._events = []
+            self._tracks = {}
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events}, f)
+
+
+profiler = Profiler()
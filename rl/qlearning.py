@@ -9,6 +9,8 @@ from rl import ReplayBuffer, PriorityReplayBuffer
 from rl import GreedyPolicy, EpsilonPolicy
 
 from rl import Statistics
+from rl.diagnostics import diagnostics
+from rl.profiler import profiler
 
 
 class QLearning:
@@ -137,6 +139,8 @@ class QLearning:
         self._optimization_step = 0
         self._step = 0
         self.eval = False
+        # Statistics of the steps since the last transitions
+        self._step_stats = Statistics()
 
     def save(self):
         return {
@@ -148,25 +152,37 @@ class QLearning:
         self._policy_net = props["policy_net"]
         self._target_net = props["target_net"]
 
-    def transitions(self, states, actions, rewards, next_states, dones):
+    def episodes_end(self):
+        return
+
+    def transitions(
+            self, states, actions, rewards, next_states, dones,
+            env_ids=None):
+        """ env_ids: environments of the transitions with partial
+        batches. Not needed, every transition goes to the replay buffer
+        on its own. """
         stats = Statistics()
+        stats.set_all(self._step_stats)
+        self._step_stats.clear()
         assert not self.eval
-        for idx in range(len(states)):
-            self._buffer.push(
-                    state=states[idx],
-                    action=actions[idx],
-                    reward=rewards[idx],
-                    next_state=next_states[idx],
-                    done=dones[idx])
+        with profiler.span("buffer_push"):
+            for idx in range(len(states)):
+                self._buffer.push(
+                        state=states[idx],
+                        action=actions[idx],
+                        reward=rewards[idx],
+                        next_state=next_states[idx],
+                        done=dones[idx])
         stats.set("replay_buffer_size", len(self._buffer))
         if len(self._buffer) >= self._min_replay_buffer_size:
             t0 = time.time()  # time spent for optimization
-            stats.set_all(self._optimize())
+            with profiler.span("optimize"):
+                stats.set_all(self._optimize())
             stats.set("optimization_time", time.time() - t0)
         return stats
 
     def step(self, states):
-        stats = Statistics()
+        stats = self._step_stats
         self._step += 1
 
         if not self.eval:
@@ -182,7 +198,8 @@ class QLearning:
             # Do logging
             q = torch.max(q_values).detach()
             stats.set('q', q)
-            self._policy_net.log_scalars(stats.set)
+            if diagnostics.due("qlearning/noise"):
+                self._policy_net.log_scalars(stats.set)
 
             try:
                 stats.set('epsilon', self._policy.get_epsilon())
@@ -230,8 +247,9 @@ class QLearning:
         except AttributeError:
             # In case it's not a PriorityReplayBuffer
             pass
-        states, actions, rewards, next_states, term, ids = self._buffer.sample(
-                self._batch_size)
+        with profiler.span("optimize/sample"):
+            states, actions, rewards, next_states, term, ids = \
+                self._buffer.sample(self._batch_size)
 
         # Make Replay Buffer values consumable by PyTorch
         states = torch.from_numpy(states).float().to(self._device)
@@ -246,6 +264,8 @@ class QLearning:
         term_mask = (1 - term_mask).float()
         next_states = torch.from_numpy(next_states).float().to(self._device)
 
+        forward_start = time.time()
+
         # Calculate TD Target
         self._sample_noise()
         if self._double:
@@ -280,14 +300,22 @@ class QLearning:
 
         stats.set('loss', loss.detach())
 
+        backward_start = time.time()
+        profiler.event(
+                "optimize/forward", forward_start,
+                backward_start - forward_start)
         self._optimizer.zero_grad()
         loss.backward()
         for param in self._policy_net.parameters():
             if param.grad is not None:
                 param.grad.data.clamp_(-1, 1)
         self._optimizer.step()
+        profiler.event(
+                "optimize/backward", backward_start,
+                time.time() - backward_start)
 
-        self._update_target_net()
+        with profiler.span("optimize/target_update"):
+            self._update_target_net()
 
         self._optimization_step += 1
 
@@ -5,6 +5,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
+from rl.diagnostics import diagnostics
+
 
 class Reinforce:
 
@@ -184,19 +186,22 @@ class Reinforce:
         stats.set('entropy', entropy.detach())
 
         # Log gradients
-        for p in self._net.parameters():
-            if p.grad is not None:
-                stats.set('grad_max', p.grad.abs().max().detach())
-                stats.set('grad_mean', (p.grad ** 2).mean().sqrt().detach())
+        if diagnostics.due("reinforce/gradients"):
+            for p in self._net.parameters():
+                if p.grad is not None:
+                    stats.set('grad_max', p.grad.abs().max().detach())
+                    stats.set(
+                            'grad_mean', (p.grad ** 2).mean().sqrt().detach())
 
         # Log Kullback-Leibler divergence between the new
-        # and the old policy.
-        new_action_logits, _ = self._net(states)
-        new_action_probs = torch.nn.Softmax(dim=1)(new_action_logits)
-        kl = -(
-                (new_action_probs / action_probs).log() * action_probs
-            ).sum(dim=1).mean()
-        stats.set('kl', kl.detach())
+        # and the old policy. It takes another forward pass.
+        if diagnostics.due("reinforce/kl"):
+            new_action_logits, _ = self._net(states)
+            new_action_probs = torch.nn.Softmax(dim=1)(new_action_logits)
+            kl = -(
+                    (new_action_probs / action_probs).log() * action_probs
+                ).sum(dim=1).mean()
+            stats.set('kl', kl.detach())
 
 
 class PolicyBaselineNet(nn.Module):
@@ -1,11 +1,12 @@
+import os
 import shutil
 import sys
 import time
 import torch
 from glob import glob
-import numpy as np
-import tensorflow as tf
 from rl import Statistics
+from rl.profiler import profiler
+from rl.summary import SummaryWriter
 
 
 class Runner(object):
@@ -19,7 +20,10 @@ class Runner(object):
             training_steps,
             evaluation_steps,
             traj_buffer,
-            bucket):
+            bucket,
+            profile=False,
+            torch_profile_iteration=None,
+            summary_dir=None):
 
         self._env = env
         self._agent = agent
@@ -28,6 +32,7 @@ class Runner(object):
         self._training_steps = training_steps
         self._evaluation_steps = evaluation_steps
         self._traj_buffer = traj_buffer
+        self._print_interval = 0.5  # seconds between progress updates
 
         print("Session ID: {}".format(self._session_id))
         print("Iterations: {}".format(self._num_iterations))
@@ -36,13 +41,18 @@ class Runner(object):
         print("Evaluation steps per iteration: {}".format(
             self._evaluation_steps))
 
+        self._profile = profile
+        self._torch_profile_iteration = torch_profile_iteration
+        if self._profile or self._torch_profile_iteration is not None:
+            print("Saving traces of the iterations to ./profiles")
+            os.makedirs("./profiles", exist_ok=True)
+
         self._bucket = bucket
-        out_dir = 'gs://{}'.format(bucket.name) if bucket is not None else '.'
-        summary_file = '{}/train/{}'.format(out_dir, self._session_id)
-        print("Saving TensorBoard stats to {}".format(summary_file))
-        self._summary_writer = tf.summary.FileWriter(summary_file, None)
+        if summary_dir is None:
+            summary_dir = 'train/{}'.format(self._session_id)
 
         self._iteration = 0
+        self._policy_version = None
         iteration, checkpoint = find_checkpoint(session_id)
         if iteration >= 0:
             print("Found checkpoint for iteration {}".format(iteration))
@@ -50,15 +60,50 @@ class Runner(object):
             self._iteration = iteration
             props = torch.load(checkpoint)
             agent.load(props)
+            if "obs_normalizer" in props:
+                assert env.normalizer is not None, \
+                    "Checkpoint was trained on normalized observations"
+                env.normalizer.load_state_dict(props["obs_normalizer"])
+        else:
+            shutil.rmtree(summary_dir, ignore_errors=True)
+
+        if bucket is not None:
+            print("Saving TensorBoard stats to gs://{}/{}".format(
+                bucket.name, summary_dir))
         else:
-            shutil.rmtree(summary_file, ignore_errors=True)
+            print("Saving TensorBoard stats to {}".format(summary_dir))
+        self._summary_writer = SummaryWriter(summary_dir, bucket)
 
     def run_experiment(self):
         for iteration in range(self._iteration, self._num_iterations):
             self._iteration = (iteration + 1)
-            statistics = self._run_one_iteration()
-            statistics.log()
-            self._checkpoint()
+            profiler.enabled = self._profile
+            if self._iteration == self._torch_profile_iteration:
+                with torch.profiler.profile() as torch_profile:
+                    statistics = self._run_one_iteration()
+                self._save_trace(torch_profile.export_chrome_trace, "torch")
+            else:
+                statistics = self._run_one_iteration()
+            with profiler.span("log"):
+                statistics.log()
+            with profiler.span("checkpoint"):
+                self._checkpoint()
+            if self._profile:
+                self._save_trace(profiler.export, "trace")
+        self.close()
+
+    def close(self):
+        """ Flushes the TensorBoard stats """
+        self._summary_writer.close()
+
+    def _save_trace(self, export_fn, kind):
+        filename = "{}-{}-{}.json".format(
+                self._session_id, kind, self._iteration)
+        path = "./profiles/{}".format(filename)
+        export_fn(path)
+        if self._bucket:
+            blob = self._bucket.blob("profiles/{}".format(filename))
+            blob.upload_from_filename(filename=path)
 
     def _checkpoint(self):
 
@@ -66,6 +111,9 @@ class Runner(object):
         filename = '{}-{}.pth'.format(self._session_id, self._iteration)
         path = './checkpoints/{}'.format(filename)
         props = self._agent.save()
+        if self._env.normalizer is not None:
+            # The agent is trained on the normalized observations
+            props["obs_normalizer"] = self._env.normalizer.state_dict()
         torch.save(props, path)
         if self._bucket:
             blob = self._bucket.blob(
@@ -87,7 +135,9 @@ class Runner(object):
         phase_stats, agent_stats = self._run_one_phase(is_training=True)
         stats.set("training_episodes", phase_stats.sum("episodes"))
         stats.set("training_steps", phase_stats.sum("steps"))
-        stats.set_all(phase_stats.get(["agent_time", "step_time", "env_time"]))
+        stats.set_all(phase_stats.get(
+            ["agent_time", "step_time", "env_time", "ready_envs",
+             "env_overlap"] + phase_stats.keys("worker_step_time/")))
         stats.set_all(agent_stats)
 
         if self._evaluation_steps != 0:
@@ -103,49 +153,92 @@ class Runner(object):
         agent_stats = Statistics()
 
         self._agent.eval = not is_training
+        if self._env.normalizer is not None:
+            self._env.normalizer.training = is_training
         min_steps = (self._training_steps if is_training
                      else self._evaluation_steps) * self._env.n_agents
 
         self._env.reset()
+        self._publish_policy()
+        last_print = 0.
         while stats.sum("steps") < min_steps:
             step_time0 = time.time()
 
-            states = np.copy(self._env.states)
-            actions = self._agent.step(states)
-
-            rewards, next_states, dones, env_stats = \
-                self._env.step(actions)
-            stats.set_all(env_stats)
+            # Environment returns new states after every step, they aren't
+            # overwritten while the agent holds them
+            states = self._env.states
+            # Workers with a copy of the policy act themselves
+            actions = None
+            if not self._env.worker_policy:
+                with profiler.span("agent_step"):
+                    actions = self._agent.step(states)
+
+            with profiler.span("env_step"):
+                rewards, next_states, dones, _ = \
+                    self._env.step(actions, stats)
+            # With partial batches the returned transitions may come
+            # from the actions of the previous steps
+            rows, states, actions, log_probs = self._env.completed
+            if len(rows) == 0:
+                continue
 
             if self._traj_buffer is not None:
-                self._traj_buffer.push(
-                        states, actions, rewards, next_states, dones)
+                with profiler.span("trajectories_push"):
+                    self._traj_buffer.push(
+                            states, actions, rewards, next_states, dones,
+                            env_ids=rows)
 
             if is_training:
                 t0 = time.time()
-                agent_stats.set_all(
-                        self._agent.transitions(
-                            states,
-                            actions,
-                            rewards,
-                            next_states,
-                            dones))
+                transitions_args = {}
+                if self._env.partial:
+                    transitions_args["env_ids"] = rows
+                if log_probs is not None:
+                    # Probabilities of the actions under the workers' policy
+                    transitions_args["log_probs"] = log_probs
+                with profiler.span("agent_transitions"):
+                    agent_stats.set_all(
+                            self._agent.transitions(
+                                states,
+                                actions,
+                                rewards,
+                                next_states,
+                                dones,
+                                **transitions_args))
+                self._publish_policy()
                 stats.set("agent_time", time.time() - t0)
                 stats.set("step_time", time.time() - step_time0)
 
-            sys.stdout.write("Iteration {} ({}). ".format(
-                                        self._iteration,
-                                        "train" if is_training else "eval") +
-                             "Steps executed: {} ".format(stats.sum("steps")) +
-                             "Episode length: {} ".format(
-                                 int(stats.avg("steps"))) +
-                             "Return: {:.4f}      \r".format(
-                                 stats.avg("rewards")))
-            sys.stdout.flush()
+            # Progress is printed a few times a second, not every step
+            log_start = time.time()
+            if log_start - last_print >= self._print_interval:
+                self._print_progress(is_training, stats)
+                last_print = log_start
+                profiler.event("log", log_start, time.time() - log_start)
+        self._print_progress(is_training, stats)
         print()
         self._agent.episodes_end()
         return stats, agent_stats
 
+    def _print_progress(self, is_training, stats):
+        sys.stdout.write("Iteration {} ({}). ".format(
+                                    self._iteration,
+                                    "train" if is_training else "eval") +
+                         "Steps executed: {} ".format(stats.sum("steps")) +
+                         "Episode length: {} ".format(
+                             int(stats.avg("steps"))) +
+                         "Return: {:.4f}      \r".format(
+                             stats.avg("rewards")))
+        sys.stdout.flush()
+
+    def _publish_policy(self):
+        if not self._env.worker_policy:
+            return
+        version = self._agent.policy_version
+        if version != self._policy_version:
+            self._env.publish(self._agent.acting_net)
+            self._policy_version = version
+
 def find_checkpoint(session):
     prefix = "checkpoints/{}-".format(session)
     suffix = ".pth"
@@ -1,66 +1,246 @@
 from collections import defaultdict
 import numpy as np
 import math
-import tensorflow as tf
+import torch
+
+
+class Accumulator(object):
+    """ Count, sum, min and max of the values """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.sum / self.count
+
+
+class Moments(Accumulator):
+    """ Also the mean and variance, by Welford's algorithm """
+
+    def __init__(self):
+        super().__init__()
+        self._mean = 0.
+        self._m2 = 0.
+
+    def add(self, value):
+        super().add(value)
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (value - self._mean)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        count = self.count
+        super().merge(other)
+        other_mean = other.mean
+        other_m2 = other._m2 if isinstance(other, Moments) else 0.
+        delta = other_mean - self._mean
+        self._mean += delta * other.count / self.count
+        self._m2 += other_m2 + delta ** 2 * count * other.count / self.count
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def var(self):
+        return self._m2 / self.count
+
+
+class Histogram(Accumulator):
+    """ Histogram of positive values with logarithmic buckets, like HDR
+    histograms: the upper bounds of the buckets grow by `growth`, so the
+    percentiles are known with the relative precision of growth - 1. """
+
+    def __init__(self, low=1e-6, high=1e4, growth=1.05):
+        super().__init__()
+        self._low = low
+        self._log_growth = math.log(growth)
+        n_buckets = int(math.ceil(math.log(high / low) / self._log_growth))
+        self.bucket_limits = low * growth ** np.arange(n_buckets + 1)
+        self.bucket_counts = np.zeros(n_buckets + 1, dtype=np.int64)
+        self.sum_squares = 0.
+
+    def add(self, value):
+        super().add(value)
+        idx = 0
+        if value > self._low:
+            idx = min(
+                    int(math.ceil(
+                        math.log(value / self._low) / self._log_growth)),
+                    len(self.bucket_counts) - 1)
+        self.bucket_counts[idx] += 1
+        self.sum_squares += value * value
+
+    def merge(self, other):
+        super().merge(other)
+        self.bucket_counts += other.bucket_counts
+        self.sum_squares += other.sum_squares
+
+    def percentile(self, q):
+        """ Upper bound of the bucket with the q-th percentile """
+        if self.count == 0:
+            return None
+        rank = max(1, int(math.ceil(q / 100. * self.count)))
+        idx = np.searchsorted(np.cumsum(self.bucket_counts), rank)
+        if idx == len(self.bucket_counts) - 1:
+            # Values above the range
+            return self.max
+        return min(max(float(self.bucket_limits[idx]), self.min), self.max)
 
 
 class Statistics(object):
+    """ Streaming accumulators of the values set by key. The type of the
+    accumulator follows the reduction of the key in `_metrics`.
+
+    Tensors are kept as they are and converted in a single batch when the
+    values are read, so setting them doesn't synchronize with the device.
+    """
+
+    # Tensors converted at once, bounds the memory they hold
+    _max_pending_tensors = 1024
+
+    # Metrics of the latency keys which are also logged as histograms
+    # and percentiles. Keys with a "/" after the prefix are per worker.
+    _histograms = {
+        'env_time': 'env_time',
+        'step_time': 'step_time',
+        'optimization_time': 'optimization_time',
+        'worker_step_time': 'worker_step_time',
+    }
+    _percentiles = [50, 90, 99]
+
+    # Metric → (reduction, key)
+    _metrics = {
+        'advantage': ('avg', 'advantage'),
+        'episode_reward': ('avg', 'episode_reward'),
+        'episode_steps': ('avg', 'episode_steps'),
+        'training_steps': ('avg', 'training_steps'),
+        'training_episodes': ('avg', 'training_episodes'),
+        'evaluation_episodes': ('avg', 'eval_episodes'),
+        'replay_buffer_beta': ('avg', 'replay_beta'),
+        'replay_buffer_size': ('max', 'replay_buffer_size'),
+        'replay_buffer_trajectories': ('max', 'replay_buffer_trajectories'),
+        'q': ('avg', 'q'),
+        'q_start': ('avg', 'q_start'),
+        'q_next_overestimate': ('avg', 'q_next_overestimate'),
+        'q_next_err': ('avg', 'q_next_err'),
+        'q_next_err_std': ('avg', 'q_next_err_std'),
+        'loss': ('avg', 'loss'),
+        'loss_actor': ('avg', 'loss_actor'),
+        'loss_critic': ('avg', 'loss_critic'),
+        'epsilon': ('avg', 'epsilon'),
+        'steps_per_second_env': ('rate', 'env_time'),
+        'steps_per_second': ('rate', 'step_time'),
+        'steps_per_second_optimization': ('rate', 'optimization_time'),
+        'ready_envs': ('avg', 'ready_envs'),
+        'env_overlap': ('avg', 'env_overlap'),
+        'ppo_optimization_epochs': ('sum', 'ppo_optimization_epochs'),
+        'ppo_optimization_samples': ('avg', 'ppo_optimization_samples'),
+        'noise_value_fc1': ('avg', 'noise_value_fc1'),
+        'noise_value_fc2': ('avg', 'noise_value_fc2'),
+        'noise_advantage_fc1': ('avg', 'noise_advantage_fc1'),
+        'noise_advantage_fc2': ('avg', 'noise_advantage_fc2'),
+        'noise_fc1': ('avg', 'noise_fc1'),
+        'noise_fc2': ('avg', 'noise_fc2'),
+        'return': ('avg', 'return'),
+        'baseline': ('avg', 'baseline'),
+        'entropy': ('avg', 'entropy'),
+        'grad_max': ('max', 'grad_max'),
+        'grad_mean': ('avg', 'grad_mean'),
+        'kl': ('avg', 'kl'),
+        'importance_ratio': ('avg', 'importance_ratio'),
+        'action_variance': ('avg', 'action_variance'),
+        'action_mu_mean': ('avg', 'action_mu_mean'),
+        'action_mu_max': ('avg', 'action_mu_max'),
+    }
+    # Reduction of every key of the metrics
+    _reductions = dict((key, fn) for fn, key in _metrics.values())
 
     def __init__(self, summary_writer=None, iteration=None):
-        self._dict = defaultdict(list)
+        self._dict = {}
+        self._pending_tensors = []
         self._summary_writer = summary_writer
         self._iteration = iteration
-        self._metrics = {
-            'advantage': (self.avg, 'advantage'),
-            'episode_reward': (self.avg, 'episode_reward'),
-            'episode_steps': (self.avg, 'episode_steps'),
-            'training_steps': (self.avg, 'training_steps'),
-            'training_episodes': (self.avg, 'training_episodes'),
-            'evaluation_episodes': (self.avg, 'eval_episodes'),
-            'replay_buffer_beta': (self.avg, 'replay_beta'),
-            'replay_buffer_size': (self.max, 'replay_buffer_size'),
-            'replay_buffer_trajectories': (
-                self.max, 'replay_buffer_trajectories'),
-            'q': (self.avg, 'q'),
-            'q_start': (self.avg, 'q_start'),
-            'q_next_overestimate': (self.avg, 'q_next_overestimate'),
-            'q_next_err': (self.avg, 'q_next_err'),
-            'q_next_err_std': (self.avg, 'q_next_err_std'),
-            'loss': (self.avg, 'loss'),
-            'loss_actor': (self.avg, 'loss_actor'),
-            'loss_critic': (self.avg, 'loss_critic'),
-            'epsilon': (self.avg, 'epsilon'),
-            'steps_per_second_env': (self.rate, 'env_time'),
-            'steps_per_second': (self.rate, 'step_time'),
-            'steps_per_second_optimization': (self.rate, 'optimization_time'),
-            'ppo_optimization_epochs': (self.sum, 'ppo_optimization_epochs'),
-            'ppo_optimization_samples': (self.avg, 'ppo_optimization_samples'),
-            'noise_value_fc1': (self.avg, 'noise_value_fc1'),
-            'noise_value_fc2': (self.avg, 'noise_value_fc2'),
-            'noise_advantage_fc1': (self.avg, 'noise_advantage_fc1'),
-            'noise_advantage_fc2': (self.avg, 'noise_advantage_fc2'),
-            'noise_fc1': (self.avg, 'noise_fc1'),
-            'noise_fc2': (self.avg, 'noise_fc2'),
-            'return': (self.avg, 'return'),
-            'baseline': (self.avg, 'baseline'),
-            'entropy': (self.avg, 'entropy'),
-            'grad_max': (self.max, 'grad_max'),
-            'grad_mean': (self.avg, 'grad_mean'),
-            'kl': (self.avg, 'kl'),
-            'action_variance': (self.avg, 'action_variance'),
-            'action_mu_mean': (self.avg, 'action_mu_mean'),
-            'action_mu_max': (self.avg, 'action_mu_max'),
-        }
 
     def set(self, key, value):
-        k = self._dict[key]
-        if isinstance(value, list):
-            k.extend(value)
+        if isinstance(value, Accumulator):
+            self._accumulator(key).merge(value)
+        elif isinstance(value, list):
+            for v in value:
+                self.set(key, v)
+        elif torch.is_tensor(value):
+            if value.dim() > 0:
+                # Queued tensors are stacked, so they all are scalars
+                value = value.detach().double().mean()
+            self._pending_tensors.append((key, value))
+            self._limit_pending_tensors()
         else:
-            k.append(value)
-        self._dict[key] = k
+            if not isinstance(value, (int, float)):
+                value = float(value)
+            self._accumulator(key).add(value)
+
+    def _accumulator(self, key):
+        if key not in self._dict:
+            self._dict[key] = self._accumulator_type(key)()
+        return self._dict[key]
+
+    def _accumulator_type(self, key):
+        if key.split("/")[0] in self._histograms.values():
+            return Histogram
+        if self._reductions.get(key, "avg") != "avg":
+            return Accumulator
+        return Moments
+
+    def _limit_pending_tensors(self):
+        if len(self._pending_tensors) >= self._max_pending_tensors:
+            self._convert_tensors()
+
+    def _convert_tensors(self):
+        """ One device synchronization per device and type """
+        if not self._pending_tensors:
+            return
+        by_device = defaultdict(list)
+        for key, tensor in self._pending_tensors:
+            by_device[(tensor.device, tensor.dtype)].append((key, tensor))
+        self._pending_tensors = []
+        for items in by_device.values():
+            values = torch.stack([t for _, t in items]).detach().double()
+            for (key, _), value in zip(items, values.cpu().tolist()):
+                self._accumulator(key).add(value)
+
+    def clear(self):
+        """ Empties the statistics for the reuse """
+        self._dict.clear()
+        self._pending_tensors = []
+
+    def keys(self, prefix=""):
+        self._convert_tensors()
+        return [key for key in self._dict if key.startswith(prefix)]
 
     def get(self, arg):
+        """ Accumulators of the keys: a dict for a list of keys, or for a
+        dict which renames them """
+        self._convert_tensors()
         if isinstance(arg, dict):
             d = {}
             for old_key, new_key in arg.items():
@@ -70,32 +250,37 @@ class Statistics(object):
         if isinstance(arg, list):
             d = {}
             for key in arg:
-                d[key] = self._dict[key]
+                if key in self._dict:
+                    d[key] = self._dict[key]
             return d
         if isinstance(arg, str):
-            return self._dict[arg]
+            return self._dict.get(arg, Accumulator())
 
     def set_all(self, props):
         if isinstance(props, Statistics):
+            self._pending_tensors.extend(props._pending_tensors)
+            self._limit_pending_tensors()
             props = props._dict
         for key, val in props.items():
             self.set(key, val)
 
     def avg(self, key):
-        if len(self._dict[key]) == 0:
+        acc = self.get(key)
+        if acc.count == 0:
             return 0.0
-        return np.average(self._dict[key])
+        return acc.mean
 
     def sum(self, key):
-        return sum(self._dict[key])
+        return self.get(key).sum
 
     def max(self, key):
-        if key not in self._dict:
+        acc = self.get(key)
+        if acc.count == 0:
             return None
-        return max(self._dict[key])
+        return acc.max
 
     def count(self, key):
-        return len(self._dict[key])
+        return self.get(key).count
 
     def rate(self, key):
         s = self.sum(key)
@@ -103,15 +288,43 @@ class Statistics(object):
             return None
         return self.count(key) / s
 
+    def percentile(self, key, q):
+        acc = self.get(key)
+        if not isinstance(acc, Histogram):
+            return None
+        return acc.percentile(q)
+
     def log(self):
+        self._convert_tensors()
         for metric, params in self._metrics.items():
             fn, key = params
-            if key in self._dict:
-                self._log_scalar(metric, fn(key))
+            if key in self._dict and self._dict[key].count > 0:
+                self._log_scalar(metric, getattr(self, fn)(key))
+        for metric, prefix in self._histograms.items():
+            for key in self.keys(prefix):
+                name = metric + key[len(prefix):]
+                histogram = self._dict[key]
+                self._log_histogram(name, histogram)
+                for q in self._percentiles:
+                    self._log_scalar(
+                            "{}_p{}".format(name, q), histogram.percentile(q))
+                self._log_scalar("{}_max".format(name), histogram.max)
 
     def _log_scalar(self, tag, value):
         if value is None or math.isnan(value):
             return
-        s = tf.Summary(
-                value=[tf.Summary.Value(tag=tag, simple_value=value)])
-        self._summary_writer.add_summary(s, self._iteration)
+        self._summary_writer.add_scalar(tag, value, self._iteration)
+
+    def _log_histogram(self, tag, histogram):
+        # Only the non-empty buckets, TensorBoard interpolates the rest
+        idx = np.flatnonzero(histogram.bucket_counts)
+        self._summary_writer.add_histogram(
+                tag,
+                self._iteration,
+                min=histogram.min,
+                max=histogram.max,
+                num=histogram.count,
+                sum=histogram.sum,
+                sum_squares=histogram.sum_squares,
+                bucket_limit=histogram.bucket_limits[idx].tolist(),
+                bucket=histogram.bucket_counts[idx].tolist())
@@ -0,0 +1,155 @@
+import os
+import socket
+import struct
+import threading
+import time
+
+
+class SummaryWriter:
+    """ Writes TensorBoard event files without TensorFlow.
+
+    Events are encoded by hand as the few protobuf messages TensorBoard
+    reads (Event, Summary, HistogramProto) and framed as TFRecords.
+    They are buffered in memory and appended to the file by a background
+    thread every `flush_secs` seconds. With a Google Cloud Storage
+    bucket the file is uploaded to the same path in the bucket after
+    every flush.
+    """
+
+    def __init__(self, logdir, bucket=None, flush_secs=10.):
+        os.makedirs(logdir, exist_ok=True)
+        self._filename = os.path.join(
+                logdir, "events.out.tfevents.{}.{}".format(
+                    int(time.time()), socket.gethostname()))
+        self._bucket = bucket
+        self._records = []
+        self._lock = threading.Lock()  # guards the records
+        self._write_lock = threading.Lock()  # guards the file
+        self._closed = threading.Event()
+        self._add_event(_field(3, _STRING, b"brain.Event:2"))
+        self._thread = threading.Thread(
+                target=self._flush_periodically, args=(flush_secs,),
+                daemon=True)
+        self._thread.start()
+
+    def add_scalar(self, tag, value, step):
+        self._add_summary(
+                _field(1, _STRING, tag.encode()) +
+                _field(2, _FLOAT, float(value)),
+                step)
+
+    def add_histogram(
+            self, tag, step, min, max, num, sum, sum_squares,
+            bucket_limit, bucket):
+        """ bucket_limit: upper bounds of the buckets, bucket: their
+        counts """
+        histo = b"".join([
+            _field(1, _DOUBLE, min),
+            _field(2, _DOUBLE, max),
+            _field(3, _DOUBLE, num),
+            _field(4, _DOUBLE, sum),
+            _field(5, _DOUBLE, sum_squares),
+            _field(6, _STRING, _packed_doubles(bucket_limit)),
+            _field(7, _STRING, _packed_doubles(bucket)),
+        ])
+        self._add_summary(
+                _field(1, _STRING, tag.encode()) +
+                _field(5, _STRING, histo),
+                step)
+
+    def _add_summary(self, value, step):
+        summary = _field(1, _STRING, value)
+        self._add_event(
+                _field(2, _VARINT, step) + _field(5, _STRING, summary))
+
+    def _add_event(self, fields):
+        event = _field(1, _DOUBLE, time.time()) + fields
+        with self._lock:
+            self._records.append(_record(event))
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                records = self._records
+                self._records = []
+            if not records:
+                return
+            with open(self._filename, "ab") as f:
+                f.write(b"".join(records))
+            if self._bucket is not None:
+                blob = self._bucket.blob(self._filename)
+                blob.upload_from_filename(filename=self._filename)
+
+    def _flush_periodically(self, flush_secs):
+        while not self._closed.wait(flush_secs):
+            self.flush()
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+
+# Protobuf wire types
+_VARINT, _DOUBLE, _STRING, _FLOAT = 0, 1, 2, 5
+
+
+def _varint(value):
+    value &= (1 << 64) - 1  # negative numbers take 10 bytes
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, wire_type, value):
+    key = _varint(number << 3 | wire_type)
+    if wire_type == _VARINT:
+        return key + _varint(int(value))
+    if wire_type == _DOUBLE:
+        return key + struct.pack("<d", value)
+    if wire_type == _FLOAT:
+        return key + struct.pack("<f", value)
+    return key + _varint(len(value)) + value
+
+
+def _packed_doubles(values):
+    return struct.pack("<{}d".format(len(values)), *values)
+
+
+def _record(data):
+    """ TFRecord: length, its CRC, data, its CRC """
+    length = struct.pack("<Q", len(data))
+    return b"".join([
+        length,
+        struct.pack("<I", _masked_crc32c(length)),
+        data,
+        struct.pack("<I", _masked_crc32c(data)),
+    ])
+
+
+def _crc32c_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_CRC32C_TABLE = _crc32c_table()
+
+
+def crc32c(data):
+    crc = 0xffffffff
+    for byte in data:
+        crc = _CRC32C_TABLE[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+def _masked_crc32c(data):
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + 0xa282ead8) & 0xffffffff
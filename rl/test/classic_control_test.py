@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+import gym
+import numpy as np
+
+from rl.classic_control import vector_envs
+
+
+class TestVectorEnvs(TestCase):
+
+    def _assert_same_step(self, env_id, actions, state_fn):
+        env = vector_envs[env_id](len(actions), seed=0)
+        env.reset()()
+        initial_state = np.copy(env.state)
+
+        env.step(actions)()
+
+        for idx, action in enumerate(actions):
+            gym_env = gym.make(env_id).unwrapped
+            gym_env.reset()
+            gym_env.state = np.copy(initial_state[idx])
+            gym_env.step(action)
+            np.testing.assert_allclose(
+                state_fn(env.state[idx]), state_fn(gym_env.state))
+
+    def test_cartpole_step(self):
+        self._assert_same_step(
+            "CartPole-v1", np.array([0, 1, 1]), np.asarray)
+
+    def test_mountaincar_step(self):
+        self._assert_same_step(
+            "MountainCar-v0", np.array([0, 1, 2]), np.asarray)
+
+    def test_pendulum_step(self):
+        self._assert_same_step(
+            "Pendulum-v0", np.array([[-3.], [0.5], [1.]]), np.asarray)
+
+    def test_auto_reset(self):
+        env = vector_envs["MountainCar-v0"](3, seed=0)
+        env.reset()()
+        # The first environment reaches the goal on the next step
+        env.state[0] = [0.55, 0.05]
+
+        next_states, rewards, dones, states = env.step(np.array([2, 1, 1]))()
+
+        np.testing.assert_array_equal(dones, [True, False, False])
+        self.assertGreaterEqual(next_states[0, 0], 0.5)
+        self.assertLess(states[0, 0], -0.4)
+        np.testing.assert_array_equal(next_states[1:], states[1:])
+
+    def test_time_limit(self):
+        env = vector_envs["Pendulum-v0"](2, seed=0)
+        env.reset()()
+        for _ in range(199):
+            _, _, dones, _ = env.step(np.zeros((2, 1)))()
+            self.assertFalse(dones.any())
+        _, _, dones, _ = env.step(np.zeros((2, 1)))()
+        self.assertTrue(dones.all())
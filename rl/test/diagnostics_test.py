@@ -0,0 +1,42 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+
+from rl.diagnostics import Diagnostics
+
+
+class TestDiagnostics(TestCase):
+
+    def test_every(self):
+        diagnostics = Diagnostics(every=3)
+
+        due = [diagnostics.due("kl") for _ in range(7)]
+
+        self.assertEqual(
+                due, [True, False, False, True, False, False, True])
+        self.assertTrue(diagnostics.due("gradients"))
+
+    def test_disabled(self):
+        diagnostics = Diagnostics(every=0)
+
+        self.assertFalse(diagnostics.due("kl"))
+
+    def test_interval(self):
+        diagnostics = Diagnostics(interval=0.05)
+
+        self.assertTrue(diagnostics.due("kl"))
+        self.assertFalse(diagnostics.due("kl"))
+        time.sleep(0.05)
+        self.assertTrue(diagnostics.due("kl"))
+
+    def test_threads(self):
+        diagnostics = Diagnostics(every=10)
+
+        def call():
+            return sum([diagnostics.due("agent-0/gradients")
+                        for _ in range(1000)])
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            sampled = sum(executor.map(lambda _: call(), range(4)))
+
+        self.assertEqual(sampled, 400)
@@ -0,0 +1,94 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+from gym.spaces import Box, Discrete
+
+from rl.impala import Impala, vtrace
+from rl.ppo import SharedWeights, WorkerPolicy
+
+
+class TestVTrace(TestCase):
+
+    def test_on_policy_returns(self):
+        # With rho = c = 1 V-trace targets are discounted returns
+        gamma = 0.9
+        rewards = torch.ones(3, 1)
+        discounts = torch.full((3, 1), gamma)
+        values = torch.zeros(3, 1)
+        bootstrap_value = torch.tensor([2.])
+
+        vs, pg_advantages = vtrace(
+                log_rhos=torch.zeros(3, 1),
+                discounts=discounts,
+                rewards=rewards,
+                values=values,
+                bootstrap_value=bootstrap_value)
+
+        expected = torch.tensor([
+            [1 + gamma + gamma ** 2 + 2 * gamma ** 3],
+            [1 + gamma + 2 * gamma ** 2],
+            [1 + 2 * gamma]])
+        self.assertTrue(torch.allclose(vs, expected))
+        self.assertTrue(torch.allclose(pg_advantages, expected))
+
+    def test_truncated_importance_weights(self):
+        rewards = torch.ones(2, 1)
+        discounts = torch.zeros(2, 1)  # every step is terminal
+        values = torch.zeros(2, 1)
+
+        vs, pg_advantages = vtrace(
+                log_rhos=torch.log(torch.tensor([[3.], [0.5]])),
+                discounts=discounts,
+                rewards=rewards,
+                values=values,
+                bootstrap_value=torch.zeros(1),
+                rho_bar=1.0)
+
+        self.assertTrue(torch.allclose(vs, torch.tensor([[1.], [0.5]])))
+        self.assertTrue(torch.allclose(
+            pg_advantages, torch.tensor([[1.], [0.5]])))
+
+
+class TestImpala(TestCase):
+
+    def test_learner_errors_are_raised(self):
+        agent = Impala(
+                Discrete(2), (4,), n_envs=2, unroll_length=2, queue_size=1)
+        agent.eval = False
+
+        def _optimize(rollout):
+            raise RuntimeError("learner failed")
+        agent._optimize = _optimize
+
+        states = np.zeros((2, 4), dtype=np.float32)
+        rewards = np.zeros(2, dtype=np.float32)
+        term = np.zeros(2, dtype=np.bool_)
+        with self.assertRaisesRegex(RuntimeError, "learner failed"):
+            for _ in range(10):
+                actions = agent.step(states)
+                agent.transitions(states, actions, rewards, states, term)
+
+    def _check_worker_log_probs(self, action_space):
+        agent = Impala(action_space, (4,), n_envs=3)
+        policy = WorkerPolicy(
+                SharedWeights(agent.acting_net), (4,), action_space)
+        states = np.random.randn(3, 4).astype(np.float32)
+
+        actions, log_probs = policy.act(states)
+
+        with torch.no_grad():
+            dist = agent._distribution(
+                    agent.acting_net(torch.from_numpy(states)))
+            expected = agent._log_prob(dist, torch.from_numpy(actions))
+        self.assertEqual(log_probs.shape, (3,))
+        self.assertTrue(torch.allclose(
+            torch.from_numpy(log_probs), expected, atol=1e-5))
+
+    def test_worker_log_probs_discrete(self):
+        self._check_worker_log_probs(Discrete(3))
+
+    def test_worker_log_probs_continuous(self):
+        self._check_worker_log_probs(Box(
+            low=-np.ones(2, dtype=np.float32),
+            high=np.ones(2, dtype=np.float32)))
@@ -0,0 +1,57 @@
+import time
+from unittest import TestCase
+
+import numpy as np
+
+from rl.env import unity_envs
+from rl.mock_unity import MockUnityEnvironment, episode_lengths
+
+
+class TestMockUnityEnvironment(TestCase):
+
+    def test_brain_specs(self):
+        config = unity_envs["crawler"]
+        env = MockUnityEnvironment(config)
+        brain_name = env.brain_names[0]
+        brain = env.brains[brain_name]
+
+        info = env.reset(train_mode=True)[brain_name]
+
+        self.assertEqual(brain.vector_action_space_size, config.action_size)
+        self.assertEqual(brain.vector_action_space_type, "continuous")
+        self.assertEqual(
+                info.vector_observations.shape,
+                (config.n_envs, config.observation_size))
+
+    def test_episode_length(self):
+        config = unity_envs["banana"]
+        env = MockUnityEnvironment(config)
+        brain_name = env.brain_names[0]
+        env.reset(train_mode=True)
+
+        length = episode_lengths["banana"][0]
+        dones = [env.step([0])[brain_name].local_done[0]
+                 for _ in range(2 * length)]
+
+        self.assertEqual(
+                list(np.flatnonzero(dones) + 1),
+                [length, 2 * length])
+
+    def test_agents_are_done_together(self):
+        env = MockUnityEnvironment(unity_envs["tennis"])
+        brain_name = env.brain_names[0]
+        env.reset(train_mode=True)
+
+        for _ in range(episode_lengths["tennis"][1]):
+            local_done = env.step([[0., 0.]] * 2)[brain_name].local_done
+            self.assertEqual(local_done[0], local_done[1])
+
+    def test_latency(self):
+        env = MockUnityEnvironment(unity_envs["banana"], latency=0.01)
+        env.reset(train_mode=True)
+
+        t0 = time.time()
+        for _ in range(5):
+            env.step([0])
+
+        self.assertGreaterEqual(time.time() - t0, 0.05)
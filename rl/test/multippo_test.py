@@ -0,0 +1,129 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+from gym.spaces import Box, Discrete
+
+from rl.multippo import (
+        MultiPPO, StackedActors, unite_states, noop_states, agent_major,
+        env_major)
+from rl.ppo import Net
+
+
+class TestStatePreprocessors(TestCase):
+
+    def test_unite_states(self):
+        n_agents, n_envs = 2, 3
+        states = np.arange(n_agents * n_envs * 4).reshape((-1, 4))
+        preprocess, shape = unite_states(n_agents, n_envs, (4,))
+
+        united = preprocess(states)
+
+        self.assertEqual(shape, (8,))
+        self.assertEqual(united.shape, (n_agents, n_envs, 8))
+        for env_idx in range(n_envs):
+            env_states = states[env_idx * n_agents:(env_idx + 1) * n_agents]
+            for agent_idx in range(n_agents):
+                np.testing.assert_array_equal(
+                    united[agent_idx, env_idx], env_states.reshape(-1))
+        self.assertTrue(united[1].flags["C_CONTIGUOUS"])
+
+    def test_unite_states_partial_batch(self):
+        n_agents, n_envs = 2, 3
+        states = np.arange(n_agents * 2 * 4).reshape((-1, 4))
+        preprocess, _ = unite_states(n_agents, n_envs, (4,))
+
+        united = preprocess(states)
+
+        self.assertEqual(united.shape, (n_agents, 2, 8))
+        np.testing.assert_array_equal(united[1, 1], states[2:].reshape(-1))
+
+    def test_noop_states(self):
+        n_agents, n_envs = 3, 2
+        states = np.arange(n_agents * n_envs * 2).reshape((-1, 2))
+        preprocess, shape = noop_states(n_agents, n_envs, (2,))
+
+        agent_states = preprocess(states)
+
+        self.assertEqual(shape, (2,))
+        for agent_idx in range(n_agents):
+            np.testing.assert_array_equal(
+                agent_states[agent_idx], states[agent_idx::n_agents])
+            self.assertTrue(agent_states[agent_idx].flags["C_CONTIGUOUS"])
+
+    def test_env_major_restores_order(self):
+        actions = np.arange(12).reshape((6, 2))
+
+        np.testing.assert_array_equal(
+            env_major(agent_major(actions, 2)), actions)
+
+
+class TestParallelOptimization(TestCase):
+
+    def _optimize(self, parallel, transitions):
+        torch.manual_seed(0)
+        agent = MultiPPO(
+                Discrete(3), (4,), n_envs=2, n_agents=2, horizon=4,
+                epochs=2, parallel=parallel)
+        agent.eval = False
+        for args in transitions:
+            stats = agent.transitions(*args)
+        return agent, stats
+
+    def test_same_as_sequential(self):
+        n_agents, n_envs, horizon = 2, 2, 4
+        batch_size = n_agents * n_envs
+        rng = np.random.RandomState(0)
+        transitions = [
+            (
+                rng.randn(batch_size, 4).astype(np.float32),
+                rng.randint(3, size=batch_size),
+                rng.randn(batch_size).astype(np.float32),
+                rng.randn(batch_size, 4).astype(np.float32),
+                np.zeros(batch_size, dtype=bool),
+            )
+            for _ in range(horizon)
+        ]
+
+        threads = torch.get_num_threads()
+        sequential, sequential_stats = self._optimize(False, transitions)
+        parallel, parallel_stats = self._optimize(True, transitions)
+
+        self.assertEqual(torch.get_num_threads(), threads)
+
+        self.assertGreater(sequential_stats.count("loss_actor"), 0)
+        for key in ["loss_actor", "loss_critic", "entropy", "kl"]:
+            self.assertAlmostEqual(
+                    parallel_stats.avg(key), sequential_stats.avg(key))
+        for seq_agent, par_agent in zip(
+                sequential._agents, parallel._agents):
+            for seq_p, par_p in zip(
+                    seq_agent.net.parameters(), par_agent.net.parameters()):
+                self.assertTrue(torch.equal(seq_p, par_p))
+
+
+class TestStackedActors(TestCase):
+
+    def _check_outputs(self, action_space):
+        torch.manual_seed(0)
+        nets = [Net((4,), action_space) for _ in range(3)]
+        states = torch.randn(len(nets), 5, 4)
+
+        stacked = StackedActors(nets)
+        outputs = stacked.forward(states)
+
+        for idx, net in enumerate(nets):
+            with torch.no_grad():
+                expected, variance, _ = net(states[idx])
+            self.assertTrue(torch.allclose(outputs[idx], expected, atol=1e-6))
+            if variance is not None:
+                self.assertTrue(torch.allclose(
+                    stacked._variance[idx].expand_as(variance), variance))
+
+    def test_discrete_logits(self):
+        self._check_outputs(Discrete(3))
+
+    def test_continuous_mu(self):
+        self._check_outputs(Box(
+            low=np.array([-1., 0.], dtype=np.float32),
+            high=np.array([1., 2.], dtype=np.float32)))
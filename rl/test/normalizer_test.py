@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+import numpy as np
+
+from rl.normalizer import ObservationNormalizer
+
+
+class TestObservationNormalizer(TestCase):
+
+    def test_bounds(self):
+        normalizer = ObservationNormalizer(
+                (2,), low=[-2., 0.], high=[2., 10.])
+
+        states = normalizer(np.array([[-2., 0.], [0., 5.], [2., 10.]]))
+
+        self.assertEqual(states.dtype, np.float32)
+        np.testing.assert_allclose(
+                states, [[-1., -1.], [0., 0.], [1., 1.]], atol=1e-6)
+
+    def test_running_moments_match_whole_data(self):
+        rng = np.random.RandomState(0)
+        data = rng.normal(3., 2., size=(1000, 3))
+        normalizer = ObservationNormalizer((3,))
+
+        for batch in np.array_split(data, 7):
+            normalizer(batch, update=True)
+
+        state = normalizer.state_dict()
+        self.assertEqual(state["count"], len(data))
+        np.testing.assert_allclose(state["mean"], data.mean(axis=0))
+        np.testing.assert_allclose(state["var"], data.var(axis=0))
+
+    def test_no_update_in_evaluation(self):
+        normalizer = ObservationNormalizer((1,))
+        normalizer(np.array([[1.], [3.]]), update=True)
+        normalizer.training = False
+
+        normalizer(np.array([[100.]]), update=True)
+
+        self.assertEqual(normalizer.state_dict()["count"], 2)
+
+    def test_clip(self):
+        normalizer = ObservationNormalizer((1,), clip=2.)
+        normalizer(np.array([[-1.], [1.]]), update=True)
+
+        states = normalizer(np.array([[0.], [100.]]))
+
+        np.testing.assert_allclose(states, [[0.], [2.]])
+
+    def test_state_dict(self):
+        normalizer = ObservationNormalizer((2,))
+        normalizer(np.random.randn(10, 2), update=True)
+        states = np.random.randn(4, 2)
+
+        restored = ObservationNormalizer.from_state_dict(
+                normalizer.state_dict())
+
+        np.testing.assert_array_equal(restored(states), normalizer(states))
+
+    def test_load_state_dict_of_another_kind(self):
+        normalizer = ObservationNormalizer((2,), low=[0., 0.], high=[1., 1.])
+        state = ObservationNormalizer((2,)).state_dict()
+
+        with self.assertRaisesRegex(AssertionError, "running statistics"):
+            normalizer.load_state_dict(state)
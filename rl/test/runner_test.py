@@ -0,0 +1,30 @@
+import tempfile
+from unittest import TestCase
+
+from rl import QLearning, Runner, create_env
+
+
+class TestRunner(TestCase):
+
+    def test_partial_batches(self):
+        env = create_env(
+                "CartPole-v1", count=4, envs_per_worker=2, min_ready_envs=1)
+        agent = QLearning(
+                action_size=env.action_space.n,
+                observation_shape=env.observation_space.shape,
+                min_replay_buffer_size=32,
+                batch_size=32)
+        try:
+            with tempfile.TemporaryDirectory() as summary_dir:
+                runner = Runner(
+                        env, agent, "partial-batches-test",
+                        num_iterations=1, training_steps=200,
+                        evaluation_steps=0, traj_buffer=None, bucket=None,
+                        summary_dir=summary_dir)
+                stats, agent_stats = runner._run_one_phase(is_training=True)
+                runner.close()
+        finally:
+            env.close()
+
+        self.assertGreaterEqual(stats.sum("steps"), 200)
+        self.assertGreater(agent_stats.max("replay_buffer_size"), 0)
@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+import numpy as np
+import torch
+
+from rl.stats import Accumulator, Histogram, Statistics
+
+
+class TestHistogram(TestCase):
+
+    def test_percentiles(self):
+        values = np.random.RandomState(0).lognormal(-5., 1., size=10000)
+        histogram = Histogram()
+        for value in values:
+            histogram.add(value)
+
+        for q in [50, 90, 99]:
+            expected = np.percentile(values, q)
+            self.assertAlmostEqual(
+                    histogram.percentile(q) / expected, 1., delta=0.05)
+        self.assertEqual(histogram.max, values.max())
+        self.assertEqual(histogram.count, len(values))
+
+    def test_outliers(self):
+        histogram = Histogram(low=1e-3, high=1.)
+        histogram.add(0.)
+        histogram.add(100.)
+
+        self.assertLessEqual(histogram.percentile(50), 1e-3)
+        self.assertEqual(histogram.percentile(100), 100.)
+
+
+class TestStatistics(TestCase):
+
+    def test_worker_histograms(self):
+        stats = Statistics()
+        for step_time in [0.01, 0.02, 0.5]:
+            stats.set("worker_step_time/3", step_time)
+        merged = Statistics()
+
+        merged.set_all(stats.get(stats.keys("worker_step_time/")))
+
+        self.assertEqual(merged.percentile("worker_step_time/3", 99), 0.5)
+        self.assertIsNone(merged.percentile("loss", 50))
+
+    def test_tensors_are_converted_when_read(self):
+        stats = Statistics()
+        stats.set("loss", torch.tensor(1.))
+        stats.set("loss", [torch.tensor(2.), 3.])
+        merged = Statistics()
+
+        merged.set_all(stats)
+
+        self.assertEqual(merged.count("loss"), 3)
+        self.assertAlmostEqual(merged.avg("loss"), 2.)
+
+    def test_tensors_of_different_shapes(self):
+        stats = Statistics()
+        stats.set("a", torch.zeros(3))
+        stats.set("b", torch.tensor(1.))
+        stats.set("a", torch.ones(2, 2))
+
+        self.assertAlmostEqual(stats.avg("b"), 1.)
+        self.assertAlmostEqual(stats.avg("a"), 0.5)
+        self.assertEqual(stats.count("a"), 2)
+
+    def test_accumulators_follow_metrics(self):
+        stats = Statistics()
+        for size in [3, 7, 5]:
+            stats.set("replay_buffer_size", size)
+            stats.set("rewards", size)
+
+        self.assertIs(type(stats.get("replay_buffer_size")), Accumulator)
+        self.assertEqual(stats.max("replay_buffer_size"), 7)
+        self.assertEqual(stats.sum("rewards"), 15)
+        self.assertAlmostEqual(stats.get("rewards").var, np.var([3, 7, 5]))
+        self.assertIsNone(stats.max("loss"))
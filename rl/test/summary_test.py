@@ -0,0 +1,89 @@
+import os
+import struct
+import tempfile
+from unittest import TestCase
+
+from rl.summary import SummaryWriter, crc32c, _masked_crc32c
+
+
+def read_records(filename):
+    with open(filename, "rb") as f:
+        data = f.read()
+    records = []
+    while data:
+        length, length_crc = struct.unpack("<QI", data[:12])
+        assert length_crc == _masked_crc32c(data[:8])
+        record = data[12:12 + length]
+        crc, = struct.unpack("<I", data[12 + length:16 + length])
+        assert crc == _masked_crc32c(record)
+        records.append(record)
+        data = data[16 + length:]
+    return records
+
+
+def parse_fields(message):
+    """ Protobuf fields by number, without the nested messages decoded """
+    fields = {}
+    pos = 0
+    while pos < len(message):
+        key, pos = parse_varint(message, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = parse_varint(message, pos)
+        elif wire_type == 1:
+            value, = struct.unpack("<d", message[pos:pos + 8])
+            pos += 8
+        elif wire_type == 5:
+            value, = struct.unpack("<f", message[pos:pos + 4])
+            pos += 4
+        else:
+            length, pos = parse_varint(message, pos)
+            value = message[pos:pos + length]
+            pos += length
+        fields[number] = value
+    return fields
+
+
+def parse_varint(message, pos):
+    value = shift = 0
+    while True:
+        byte = message[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+class TestSummaryWriter(TestCase):
+
+    def test_crc32c(self):
+        self.assertEqual(crc32c(b"123456789"), 0xe3069283)
+
+    def test_events(self):
+        logdir = tempfile.mkdtemp()
+        writer = SummaryWriter(logdir)
+        writer.add_scalar("loss", 0.5, step=3)
+        writer.add_histogram(
+                "env_time", 4, min=1., max=3., num=2, sum=4.,
+                sum_squares=10., bucket_limit=[1., 3.], bucket=[1, 1])
+        writer.close()
+
+        filename, = os.listdir(logdir)
+        self.assertTrue(filename.startswith("events.out.tfevents."))
+        events = [parse_fields(record)
+                  for record in read_records(os.path.join(logdir, filename))]
+
+        self.assertEqual(len(events), 3)
+        self.assertEqual(events[0][3], b"brain.Event:2")
+
+        self.assertEqual(events[1][2], 3)
+        value = parse_fields(parse_fields(events[1][5])[1])
+        self.assertEqual(value, {1: b"loss", 2: 0.5})
+
+        self.assertEqual(events[2][2], 4)
+        value = parse_fields(parse_fields(events[2][5])[1])
+        self.assertEqual(value[1], b"env_time")
+        histo = parse_fields(value[5])
+        self.assertEqual(histo[2], 3.)
+        self.assertEqual(struct.unpack("<2d", histo[6]), (1., 3.))
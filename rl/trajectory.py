@@ -137,15 +137,19 @@ class TrajectoryBuffer:
             b._append(traj)
         return b
 
-    def push(self, states, actions, rewards, next_states, dones):
-        for idx in range(len(states)):
+    def push(self, states, actions, rewards, next_states, dones,
+             env_ids=None):
+        """ env_ids: environment of each row, by default row index """
+        if env_ids is None:
+            env_ids = range(len(states))
+        for idx, env_idx in enumerate(env_ids):
             self._push_single(
                     states[idx],
                     actions[idx],
                     rewards[idx],
                     next_states[idx],
                     dones[idx],
-                    idx)
+                    env_idx)
 
     def _push_single(self, state, action, reward, next_state, done, env_idx):
         if env_idx not in self._trajectories:
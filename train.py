@@ -1,15 +1,51 @@
 import argparse
-from google.cloud import storage
 
 from rl import Runner, TrajectoryBuffer, create_env, create_agent
+from rl.diagnostics import diagnostics
+from rl.env_server import RemoteEnv
 
 
 BUCKET = 'rl-1'
+# Agents which take the transitions of a part of the environments
+partial_batch_agents = ["ppo", "multippo", "qlearning", "actor-critic"]
+# Agents which networks can act in the worker processes
+worker_policy_agents = ["ppo", "impala"]
 
 
 def main(**args):
+    assert not args["worker_policy"] or \
+        args["agent"] in worker_policy_agents, \
+        "Networks which can act in the worker processes: " + \
+        ", ".join(worker_policy_agents)
+    assert not (args["min_ready_envs"] or args["split_envs"]) or \
+        args["agent"] in partial_batch_agents, \
+        "Partial batches and split environments are supported by: " + \
+        ", ".join(partial_batch_agents)
+    diagnostics.every = args["diagnostics_every"]
+    diagnostics.interval = args["diagnostics_interval"]
     envs_count = args["env_count"]
-    env = create_env(args["env"], envs_count)
+    mock_unity = None
+    if args["mock_unity"]:
+        mock_unity = {
+            "latency": args["mock_latency"] / 1000.,
+            "jitter": args["mock_jitter"] / 1000.,
+        }
+    env_options = dict(
+            env_id=args["env"],
+            count=envs_count,
+            envs_per_worker=args["envs_per_worker"],
+            min_ready_envs=args["min_ready_envs"],
+            spare_envs=args["spare_envs"],
+            split=args["split_envs"],
+            worker_policy=args["worker_policy"],
+            vectorized=args["vectorized_env"],
+            normalize_obs=args["normalize_obs"],
+            train_mode=not args["realtime_env"],
+            mock_unity=mock_unity)
+    if args["env_server"]:
+        env = RemoteEnv(args["env_server"], **env_options)
+    else:
+        env = create_env(**env_options)
     del args["env"]
 
     agent = create_agent(env, args)
@@ -26,6 +62,7 @@ def main(**args):
     bucket = None
     gcp = args["gcp"]
     if gcp:
+        from google.cloud import storage
         client = storage.Client()
         bucket = client.get_bucket(BUCKET)
 
@@ -48,17 +85,55 @@ def main(**args):
             traj_buffer=traj_buffer,
             num_iterations=iterations,
             training_steps=training_steps,
-            evaluation_steps=evaluation_steps)
+            evaluation_steps=evaluation_steps,
+            profile=args["profile"],
+            torch_profile_iteration=args["torch_profile_iteration"])
     runner.run_experiment()
 
 
-if __name__ == '__main__':
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--sess", type=str)
     parser.add_argument("--env", type=str)
     parser.add_argument("--env_count", type=int, default=1)
+    parser.add_argument("--envs_per_worker", type=int, default=0,
+            help="Environments per worker process. 0: step OpenAI Gym " +
+            "environments in the main process, one Unity environment " +
+            "per process.")
+    parser.add_argument("--min_ready_envs", type=int, default=0,
+            help="Step worker processes asynchronously and return once " +
+            "at least N of them are ready. 0: wait for all of them.")
+    parser.add_argument("--spare_envs", type=int, default=0,
+            help="Environments per worker process which are reset in " +
+            "background and replace the environments which episode ended.")
+    parser.add_argument("--split_envs", action="store_true",
+            help="Split worker processes into two groups, the agent acts " +
+            "for one group while the other one simulates.")
+    parser.add_argument("--worker_policy", action="store_true",
+            help="Worker processes act with a copy of the PPO or IMPALA " +
+            "network which is updated through the shared memory.")
+    parser.add_argument("--vectorized_env", action="store_true",
+            help="Step CartPole-v1, MountainCar-v0 or Pendulum-v0 " +
+            "implemented with NumPy arrays, all environments at once.")
+    parser.add_argument("--normalize_obs", action="store_true",
+            help="Normalize observations by their running mean and " +
+            "variance. The statistics are saved in the checkpoints.")
+    parser.add_argument("--realtime_env", action="store_true",
+            help="Run Unity environments in real time instead of the " +
+            "training time scale, the same way as play.py does.")
+    parser.add_argument("--mock_unity", action="store_true",
+            help="Replace the Unity builds with a synthetic environment " +
+            "of the same specs, e.g. for benchmarks.")
+    parser.add_argument("--mock_latency", type=float, default=0.,
+            help="Simulation time of a mock Unity step, milliseconds")
+    parser.add_argument("--mock_jitter", type=float, default=0.,
+            help="Random deviation of the mock Unity step time, " +
+            "milliseconds")
+    parser.add_argument("--env_server", type=str,
+            help="Unix socket of env_server.py to lease the warm " +
+            "environments from instead of starting them.")
     parser.add_argument("--agent", type=str, default="qlearning",
-            help="qlearning|reinforce|actor-critic")
+            help="qlearning|reinforce|actor-critic|ppo|multippo|impala")
     parser.add_argument("--dueling", action="store_true")
     parser.add_argument("--double", action="store_true")
     parser.add_argument("--noisy", action="store_true",
@@ -104,6 +179,35 @@ if __name__ == '__main__':
         help="PPO parameter. Epochs count in the optimization phase.")
     parser.add_argument("--gae_lambda", type=float, default=0.95,
         help="lambda parameter for Advantage Function Estimation (GAE)")
+    parser.add_argument("--pipeline", action="store_true",
+        help="PPO parameter. Collect the next rollout with a snapshot " +
+        "of the policy while optimizing on the previous one.")
+    parser.add_argument("--stacked", action="store_true",
+        help="MultiPPO parameter. Evaluate all sub-agents in a single " +
+        "batched forward pass with stacked weights.")
+    parser.add_argument("--parallel_agents", action="store_true",
+        help="MultiPPO parameter. Optimize the sub-agents concurrently.")
+    parser.add_argument("--shared_policy", action="store_true",
+        help="MultiPPO parameter. Single policy acts for every agent " +
+        "and is trained on the experience of all of them.")
+    parser.add_argument("--agent_id", action="store_true",
+        help="MultiPPO parameter. Append one-hot agent id to the states.")
+    parser.add_argument("--unroll_length", type=int, default=20,
+        help="IMPALA parameter. Length of the rollouts sent by the " +
+        "actors to the learner.")
+    parser.add_argument("--profile", action="store_true",
+            help="Save Chrome traces of the training loop phases to " +
+            "./profiles, one per iteration.")
+    parser.add_argument("--torch_profile_iteration", type=int,
+            help="Run the iteration under torch.profiler and save its " +
+            "Chrome trace to ./profiles.")
+    parser.add_argument("--diagnostics_every", type=int, default=1,
+            help="Compute the diagnostic statistics (gradients, noise, " +
+            "KL divergence) on every N-th optimization or step. " +
+            "0: never.")
+    parser.add_argument("--diagnostics_interval", type=float,
+            help="Compute the diagnostic statistics at most once per " +
+            "this many seconds, overrides --diagnostics_every.")
     parser.add_argument("--save_traj", action="store_true",
             help="Enables persisting trajectories on disk during " +
             "training/execution time.")
@@ -116,7 +220,16 @@ if __name__ == '__main__':
     parser.set_defaults(baseline=False)
     parser.set_defaults(gcp=False)
     parser.set_defaults(save_traj=False)
-    args = parser.parse_args()
+    parser.set_defaults(pipeline=False)
+    parser.set_defaults(stacked=False)
+    parser.set_defaults(parallel_agents=False)
+    parser.set_defaults(shared_policy=False)
+    parser.set_defaults(agent_id=False)
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
 
     d = vars(args)
     main(**d)